@@ -0,0 +1,308 @@
+'''
+Offline benchmark for the bot's commands. Builds a throwaway ./files tree, points croc_path at
+fake_croc.py and drives /upload, /download, /ls, /ps and /kill through the cogs with stub
+interactions, then reports per command latency (p50/p99), time to first answer, event loop lag
+and CPU time per transfer.
+
+    python benchmarks/bench.py --concurrency 16 --requests 200 --files 20000
+    python benchmarks/bench.py --commands download --set archive_cache_enabled=true
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+FAKE_CROC = os.path.join(BENCH_DIR, 'fake_croc.py')
+COMMANDS = ['ls', 'ps', 'download', 'upload', 'kill']
+TRANSFERS = ('download', 'upload')
+
+def percentile(values:list[float], pct:float) -> float:
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def make_tree(root:str, files:int, depth:int, fanout:int, file_kb:int, seed:int) -> tuple[list[str], list[str]]:
+    '''
+    Sparse files spread over a tree of folders, returns the relative file and folder paths
+    '''
+    rng = random.Random(seed)
+    folders = ['']
+    frontier = ['']
+    for level in range(depth):
+        frontier = [f'{parent}/dir{level}_{i}'.lstrip('/') for parent in frontier for i in range(fanout)]
+        folders.extend(frontier)
+    paths = []
+    for i in range(files):
+        folder = rng.choice(folders)
+        path = f'{folder}/file_{i}.bin'.lstrip('/')
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+        with open(os.path.join(root, path), 'wb') as f:
+            f.truncate(file_kb * 1024)
+        paths.append(path)
+    return paths, [folder for folder in folders if folder]
+
+class LoopLagMonitor:
+    '''
+    Samples how late asyncio.sleep(interval) wakes up, i.e. how long callbacks block the loop
+    '''
+    def __init__(self, interval:float = 0.01):
+        self.interval = interval
+        self.samples: list[float] = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+    def take(self) -> list[float]:
+        samples, self.samples = self.samples, []
+        return samples
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - start - self.interval))
+
+class Bench:
+    def __init__(self, args, stubs, transfer_cog, management_cog, files:list[str], folders:list[str]):
+        self.args = args
+        self.stubs = stubs
+        self.transfer = transfer_cog
+        self.management = management_cog
+        self.files = files
+        self.folders = folders
+        self.rng = random.Random(args.seed)
+        self.user_ids = iter(range(1, 1 << 30))
+
+    def interaction(self):
+        guild = f'bench{self.rng.randrange(self.args.guilds)}'
+        return self.stubs.StubInteraction(guild, next(self.user_ids) % self.args.users)
+
+    def invoke(self, command:str):
+        interaction = self.interaction()
+        match command:
+            case 'ls':
+                if self.rng.random() < 0.5:
+                    call = self.management.ls.callback(self.management, interaction, folder=self.rng.choice(self.folders or ['./']))
+                else:
+                    call = self.management.ls.callback(self.management, interaction, filter=f'file_{self.rng.randrange(100)}')
+            case 'ps':
+                call = self.transfer.ps.callback(self.transfer, interaction)
+            case 'download':
+                target = self.rng.choice(self.folders) if self.folders and self.rng.random() < self.args.folder_ratio else self.rng.choice(self.files)
+                call = self.transfer.download.callback(self.transfer, interaction, target)
+            case 'upload':
+                call = self.transfer.upload.callback(self.transfer, interaction, f'{self.rng.randrange(1000, 9999)}-bench-upload')
+            case _:
+                raise ValueError(f'unknown command {command}')
+        return interaction, call
+
+    async def run_phase(self, command:str) -> dict:
+        latencies = []
+        answers = []
+        failures = 0
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        async def one():
+            nonlocal failures
+            async with semaphore:
+                interaction, call = self.invoke(command)
+                start = time.perf_counter()
+                try:
+                    await call
+                except Exception as e:
+                    failures += 1
+                    print(f'{command} failed: {e!r}', file=sys.stderr)
+                latencies.append(time.perf_counter() - start)
+                answer = interaction.message.first_answer()
+                if answer is not None:
+                    answers.append(answer)
+        await asyncio.gather(*(one() for _ in range(self.args.requests)))
+        return {'latencies': latencies, 'answers': answers, 'failures': failures}
+
+    async def run_kill_phase(self) -> dict:
+        '''
+        Start downloads nobody will receive, then /kill them one at a time
+        '''
+        latencies = []
+        failures = 0
+        os.environ['FAKE_CROC_PEER_DELAY'] = '3600'
+        guild = 'bench0'
+        downloads = []
+        for _ in range(self.args.requests):
+            interaction = self.stubs.StubInteraction(guild, next(self.user_ids) % self.args.users)
+            downloads.append(asyncio.create_task(self.transfer.download.callback(self.transfer, interaction, self.rng.choice(self.files))))
+            while 'Code:' not in (interaction.message.content or '') and not downloads[-1].done():
+                await asyncio.sleep(0.005)
+            start = time.perf_counter()
+            try:
+                await self.transfer.kill.callback(self.transfer, self.stubs.StubInteraction(guild, 0), 0)
+            except Exception as e:
+                failures += 1
+                print(f'kill failed: {e!r}', file=sys.stderr)
+            latencies.append(time.perf_counter() - start)
+        await asyncio.gather(*downloads, return_exceptions=True)
+        os.environ['FAKE_CROC_PEER_DELAY'] = str(self.args.peer_delay)
+        return {'latencies': latencies, 'answers': latencies, 'failures': failures}
+
+def cpu_times() -> tuple[float, float]:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime
+
+def write_config(path:str, overrides:list[str]):
+    with open(os.path.join(REPO_ROOT, 'config.json')) as f:
+        config = json.load(f)
+    config['croc_path'] = FAKE_CROC
+    for override in overrides:
+        key, _, value = override.partition('=')
+        try:
+            config[key] = json.loads(value)
+        except json.JSONDecodeError:
+            config[key] = value
+    with open(path, 'w') as f:
+        json.dump(config, f, indent=2)
+
+async def run(args) -> dict:
+    # the bot reads ./config.json and ./files relative to the working directory at import time
+    sys.path.insert(0, REPO_ROOT)
+    import stubs
+    from src.utils import get_logger
+    from src.file_index import get_file_index
+    from src.journal import get_transfer_journal
+    from src.cogs.transfer_cog import FileTransferCog
+    from src.cogs.file_management_cog import FileManagementCog
+    stubs.install()
+    logger = get_logger()
+    if not args.verbose:
+        for handler in logger.handlers:
+            handler.setLevel('WARNING')
+
+    files, folders = [], []
+    for guild in range(args.guilds):
+        files, folders = make_tree(f'./files/bench{guild}', args.files, args.depth, args.fanout, args.file_kb, args.seed)
+
+    await get_transfer_journal().recover()
+    index = get_file_index()
+    start = time.perf_counter()
+    await index.start(args.poll_interval)
+    for guild in range(args.guilds):
+        await index.ensure_guild(f'bench{guild}')
+    results = {'index_build_s': time.perf_counter() - start, 'commands': {}}
+
+    transfer = FileTransferCog(None)
+    management = FileManagementCog(None)
+    await transfer.cog_load()
+    bench = Bench(args, stubs, transfer, management, files, folders)
+    monitor = LoopLagMonitor()
+    monitor.start()
+    try:
+        for command in args.commands:
+            monitor.take()
+            own_before, children_before = cpu_times()
+            start = time.perf_counter()
+            if command == 'kill':
+                phase = await bench.run_kill_phase()
+            else:
+                phase = await bench.run_phase(command)
+            wall = time.perf_counter() - start
+            own_after, children_after = cpu_times()
+            lag = monitor.take() or [0.0]
+            latencies, answers = phase['latencies'], phase['answers']
+            result = {
+                'requests': len(latencies),
+                'failures': phase['failures'],
+                'wall_s': wall,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'first_answer_p50_ms': percentile(answers, 50) * 1000,
+                'first_answer_p99_ms': percentile(answers, 99) * 1000,
+                'loop_lag_p50_ms': percentile(lag, 50) * 1000,
+                'loop_lag_p99_ms': percentile(lag, 99) * 1000,
+                'loop_lag_max_ms': max(lag) * 1000,
+            }
+            if command in TRANSFERS:
+                result['bot_cpu_ms_per_transfer'] = (own_after - own_before) / max(1, len(latencies)) * 1000
+                result['croc_cpu_ms_per_transfer'] = (children_after - children_before) / max(1, len(latencies)) * 1000
+            results['commands'][command] = result
+    finally:
+        monitor.stop()
+        await transfer.cog_unload()
+        index.stop()
+    return results
+
+def report(results:dict):
+    print(f"index build: {results['index_build_s'] * 1000:.1f} ms")
+    columns = ['requests', 'failures', 'p50_ms', 'p99_ms', 'first_answer_p50_ms', 'first_answer_p99_ms', 'loop_lag_p99_ms', 'loop_lag_max_ms', 'bot_cpu_ms_per_transfer', 'croc_cpu_ms_per_transfer']
+    print(f"{'command':<10}" + ''.join(f'{column:>26}' for column in columns))
+    for command, result in results['commands'].items():
+        cells = []
+        for column in columns:
+            value = result.get(column)
+            cells.append(f'{"-":>26}' if value is None else f'{value:>26.2f}' if isinstance(value, float) else f'{value:>26}')
+        print(f'{command:<10}' + ''.join(cells))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the bot\'s commands against a fake croc')
+    parser.add_argument('--commands', default=','.join(COMMANDS), help='comma separated commands to run, in order')
+    parser.add_argument('--requests', type=int, default=50, help='invocations per command')
+    parser.add_argument('--concurrency', type=int, default=8, help='invocations in flight at once')
+    parser.add_argument('--guilds', type=int, default=1, help='guilds the invocations are spread over')
+    parser.add_argument('--users', type=int, default=8, help='distinct users the invocations are spread over')
+    parser.add_argument('--files', type=int, default=2000, help='files in each guild\'s tree')
+    parser.add_argument('--depth', type=int, default=3, help='folder depth of the tree')
+    parser.add_argument('--fanout', type=int, default=4, help='subfolders per folder')
+    parser.add_argument('--file-kb', type=int, default=64, help='size of each (sparse) file')
+    parser.add_argument('--folder-ratio', type=float, default=0.1, help='share of downloads that ask for a folder')
+    parser.add_argument('--speed', type=float, default=100, help='fake croc transfer speed in MB/s')
+    parser.add_argument('--upload-mb', type=float, default=10, help='size of each fake upload')
+    parser.add_argument('--peer-delay', type=float, default=0.2, help='seconds before the fake peer connects')
+    parser.add_argument('--poll-interval', type=float, default=30, help='index_poll_interval_s for the run')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='override a config.json key (JSON value)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary working directory')
+    parser.add_argument('--verbose', action='store_true', help='show the bot\'s log output')
+    args = parser.parse_args()
+    args.commands = [command.strip() for command in args.commands.split(',') if command.strip()]
+    for command in args.commands:
+        if command not in COMMANDS:
+            parser.error(f'unknown command {command}, choose from {COMMANDS}')
+    return args
+
+def main():
+    args = parse_args()
+    os.environ['FAKE_CROC_SPEED_MB'] = str(args.speed)
+    os.environ['FAKE_CROC_SIZE_MB'] = str(args.upload_mb)
+    os.environ['FAKE_CROC_PEER_DELAY'] = str(args.peer_delay)
+    json_path = os.path.abspath(args.json) if args.json else None
+    workdir = tempfile.mkdtemp(prefix='float-bench-')
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        write_config('./config.json', args.set)
+        results = asyncio.run(run(args))
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f'working directory kept at {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report(results)
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
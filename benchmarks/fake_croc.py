@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+'''
+Stand-in for the croc binary used by the benchmarks. It accepts the same arguments the bot
+passes, prints what croc prints (offer, code, accept prompt, progress bars) and fakes the
+transfer at a configurable speed. Tuned with environment variables:
+
+FAKE_CROC_SPEED_MB    transfer speed in MB/s (default 100)
+FAKE_CROC_SIZE_MB     size of files received by uploads (default 10)
+FAKE_CROC_CODE_DELAY  seconds before a sender prints its code (default 0.05)
+FAKE_CROC_PEER_DELAY  seconds before the other side connects (default 0.2)
+FAKE_CROC_TICK        seconds between progress bar redraws (default 0.1)
+FAKE_CROC_FAIL        set to 1 to make every receive fail like a bad code
+
+--throttleUpload (in bytes per second) caps the speed of a send like it does for croc.
+'''
+import os
+import random
+import sys
+import time
+
+SPEED_MB = float(os.environ.get('FAKE_CROC_SPEED_MB', 100))
+SIZE_MB = float(os.environ.get('FAKE_CROC_SIZE_MB', 10))
+CODE_DELAY = float(os.environ.get('FAKE_CROC_CODE_DELAY', 0.05))
+PEER_DELAY = float(os.environ.get('FAKE_CROC_PEER_DELAY', 0.2))
+TICK = float(os.environ.get('FAKE_CROC_TICK', 0.1))
+FAIL = os.environ.get('FAKE_CROC_FAIL') == '1'
+BAR_WIDTH = 20
+WORDS = ['alpha', 'bravo', 'delta', 'echo', 'lima', 'oscar', 'sierra', 'tango']
+
+def out(text:str):
+    sys.stderr.write(text)
+    sys.stderr.flush()
+
+def size_text(mb:float) -> str:
+    if mb < 1:
+        return f'{mb * 1024:.1f} kB'
+    return f'{mb:.1f} MB'
+
+def path_size_mb(path:str) -> tuple[float, int, int]:
+    if not os.path.isdir(path):
+        return os.path.getsize(path) / (1024 * 1024), 1, 0
+    total, files, folders = 0, 0, 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        folders += len(dirnames)
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+            files += 1
+    return total / (1024 * 1024), files, folders
+
+def progress(name:str, size_mb:float, speed_mb:float = SPEED_MB):
+    '''
+    Redraw a progress bar with carriage returns until size_mb has "moved" at speed_mb
+    '''
+    duration = size_mb / speed_mb if speed_mb > 0 else 0
+    start = time.monotonic()
+    while True:
+        elapsed = time.monotonic() - start
+        done = min(1.0, elapsed / duration) if duration else 1.0
+        filled = int(done * BAR_WIDTH)
+        bar = '█' * filled + ' ' * (BAR_WIDTH - filled)
+        out(f'\r{name} {int(done * 100):3d}% |{bar}| ({size_mb * done:.1f}/{size_mb:.1f} MB, {speed_mb:.1f} MB/s)')
+        if done >= 1.0:
+            break
+        time.sleep(min(TICK, duration - elapsed))
+    out('\n')
+
+def send(paths:list[str], speed_mb:float):
+    sizes = [path_size_mb(path) for path in paths]
+    size_mb = sum(size for size, _, _ in sizes)
+    files = sum(count for _, count, _ in sizes)
+    folders = sum(count for _, _, count in sizes) + sum(1 for path in paths if os.path.isdir(path))
+    name = os.path.basename(os.path.normpath(paths[0]))
+    time.sleep(CODE_DELAY)
+    if len(paths) > 1 or os.path.isdir(paths[0]):
+        out(f'Sending {files} files and {folders} folders ({size_text(size_mb)})\n')
+    else:
+        out(f"Sending '{name}' ({size_text(size_mb)})\n")
+    code = f'{random.randint(1000, 9999)}-{random.choice(WORDS)}-{random.choice(WORDS)}-{random.choice(WORDS)}'
+    out(f'Code is: {code}\nOn the other computer run\n\ncroc {code}\n')
+    time.sleep(PEER_DELAY)
+    out(f'Sending (->127.0.0.1:{random.randint(40000, 60000)})\n')
+    progress(name, size_mb, speed_mb)
+
+def receive(code:str, out_dir:str):
+    time.sleep(PEER_DELAY)
+    if FAIL:
+        out('error: room not ready\n')
+        sys.exit(1)
+    name = f'upload-{code}.bin'
+    out(f"Accept '{name}' ({size_text(SIZE_MB)})? (Y/n) ")
+    if sys.stdin.readline().strip().lower() not in ('', 'y', 'yes'):
+        out('error: refusing files\n')
+        sys.exit(1)
+    out(f'\nReceiving (<-127.0.0.1:{random.randint(40000, 60000)})\n')
+    progress(name, SIZE_MB)
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, name), 'wb') as f:
+        f.truncate(int(SIZE_MB * 1024 * 1024))
+
+def main(argv:list[str]):
+    out_dir = '.'
+    speed_mb = SPEED_MB
+    positional = []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in ('--relay', '--pass'):
+            i += 1
+        elif arg == '--out':
+            out_dir = argv[i + 1]
+            i += 1
+        elif arg == '--throttleUpload':
+            speed_mb = min(speed_mb, int(argv[i + 1]) / (1024 * 1024))
+            i += 1
+        elif not arg.startswith('--'):
+            positional.append(arg)
+        i += 1
+    if positional[:1] == ['send']:
+        for path in positional[1:]:
+            if not os.path.exists(path):
+                out(f'error: could not find {path}\n')
+                sys.exit(1)
+        send(positional[1:], speed_mb)
+    elif positional:
+        receive(positional[0], out_dir)
+    else:
+        out('error: nothing to do\n')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,68 @@
+'''
+Just enough of discord.Interaction and commands.Context for the cogs' command callbacks to run
+without a gateway connection. Every message edit is timestamped so the benchmark can tell when
+a command first answered the user.
+'''
+import time
+from discord.ext import commands
+
+class StubMessage:
+    def __init__(self):
+        self.created = time.perf_counter()
+        self.edits: list[tuple[float, str]] = []
+
+    async def edit(self, content:str | None = None, **kwargs):
+        self.edits.append((time.perf_counter(), content))
+        return self
+
+    @property
+    def content(self) -> str | None:
+        return self.edits[-1][1] if self.edits else None
+
+    def first_answer(self) -> float | None:
+        '''
+        Seconds until the first edit that isn't a queue position update
+        '''
+        for at, content in self.edits:
+            if content and not content.startswith('Waiting for a free transfer slot'):
+                return at - self.created
+        return None
+
+class StubResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send_message(self, content:str | None = None, **kwargs):
+        self.interaction.message.edits.append((time.perf_counter(), content))
+
+class StubContext:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def reply(self, content:str | None = None, **kwargs):
+        return self.interaction.message
+
+class StubUser:
+    def __init__(self, user_id:int):
+        self.id = user_id
+        self.global_name = f'bench-user-{user_id}'
+
+class StubGuild:
+    def __init__(self, name:str):
+        self.name = name
+
+class StubInteraction:
+    def __init__(self, guild:str, user_id:int):
+        self.guild = StubGuild(guild)
+        self.user = StubUser(user_id)
+        self.message = StubMessage()
+        self.response = StubResponse(self)
+
+async def _context_from_interaction(cls, interaction):
+    return StubContext(interaction)
+
+def install():
+    '''
+    Make commands.Context.from_interaction accept stub interactions
+    '''
+    commands.Context.from_interaction = classmethod(_context_from_interaction)
@@ -1,25 +1,103 @@
 import discord
 from discord.ext import commands
-from dotenv import load_dotenv 
+from dotenv import load_dotenv
+import asyncio
+import hashlib
+import json
 import os
-from src.utils import get_logger
+import time
+from src.file_index import get_file_index
+from src.journal import get_transfer_journal
+from src.utils import get_config, get_logger
 
 load_dotenv()
 
+EXTENSIONS = ('src.cogs.transfer_cog', 'src.cogs.file_management_cog', 'src.cogs.stats_cog')
+TREE_FINGERPRINT_FILE = './files/.command_tree'
+STARTED = time.perf_counter()
+
 intents = discord.Intents.all()
 client = commands.Bot(command_prefix='/',intents=intents)
 bot_token = os.environ['BOT_TOKEN']
+background_tasks = set()
+
+async def timed(timings:dict[str, float], phase:str, coro):
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        timings[phase] = time.perf_counter() - start
+
+def tree_fingerprint() -> str:
+    '''
+    Hash of everything a sync would upload, so an unchanged tree is never pushed to discord again
+    '''
+    payload = [command.to_dict() for command in client.tree.get_commands()]
+    data = json.dumps({'application': client.application_id, 'commands': sorted(payload, key=lambda command: (command.get('type', 1), command['name']))}, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+def read_fingerprint() -> str | None:
+    try:
+        with open(TREE_FINGERPRINT_FILE) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def write_fingerprint(fingerprint:str):
+    os.makedirs(os.path.dirname(TREE_FINGERPRINT_FILE), exist_ok=True)
+    with open(TREE_FINGERPRINT_FILE, 'w') as f:
+        f.write(fingerprint)
+
+async def sync_tree():
+    logger = get_logger()
+    fingerprint = tree_fingerprint()
+    if await asyncio.to_thread(read_fingerprint) == fingerprint:
+        logger.debug('STARTUP - command tree unchanged, skipping sync')
+        return
+    synced = await client.tree.sync()
+    await asyncio.to_thread(write_fingerprint, fingerprint)
+    logger.debug(f'synced {len(synced)} commands')
+
+async def load_extensions(timings:dict[str, float]):
+    logger = get_logger()
+    results = await asyncio.gather(*(timed(timings, extension, client.load_extension(extension)) for extension in EXTENSIONS), return_exceptions=True)
+    for extension, result in zip(EXTENSIONS, results):
+        if isinstance(result, BaseException):
+            logger.error(f'failed to load {extension}: {result}')
+
+async def build_index():
+    logger = get_logger()
+    config = get_config()
+    start = time.perf_counter()
+    try:
+        await get_file_index().start(config.index_poll_interval_s, config.index_reconcile_interval_s)
+        logger.info(f'STARTUP - file index ready in {time.perf_counter() - start:.2f}s')
+    except Exception as e:
+        logger.error(f'failed to build the file index: {e}')
 
 @client.event
-async def on_ready():
+async def setup_hook():
+    '''
+    Runs once per process, before the gateway connects. The file index is built in the background,
+    commands that need a guild before it is done build that guild's index on demand.
+    '''
     logger = get_logger()
+    timings = {'login': time.perf_counter() - STARTED}
+    # the journal reaps orphans and clears stale staging, it must be done before the cogs start any croc
+    await timed(timings, 'journal', get_transfer_journal().recover())
+    task = asyncio.create_task(build_index())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    await timed(timings, 'extensions', load_extensions(timings))
     try:
-        await client.load_extension('src.cogs.transfer_cog')
-        await client.load_extension('src.cogs.file_management_cog')
-        synced = await client.tree.sync()
-        logger.debug(f'synced {len(synced)} commands')
+        await timed(timings, 'tree sync', sync_tree())
     except Exception as e:
-        logger.error(f'failed to load cogs and sync tree: {e}')
-    logger.info(f'Logged in as {client.user}')
+        logger.error(f'failed to sync tree: {e}')
+    logger.info(f'STARTUP - setup done in {time.perf_counter() - STARTED:.2f}s: {", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items())}')
+
+@client.event
+async def on_ready():
+    logger = get_logger()
+    logger.info(f'Logged in as {client.user}, ready {time.perf_counter() - STARTED:.2f}s after start')
 
 client.run(bot_token)
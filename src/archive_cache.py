@@ -0,0 +1,136 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import time
+import zipfile
+from src.fs_executor import get_fs_executor
+from src.utils import get_logger
+
+ARCHIVE_ROOT = './files/.archives'
+
+def tree_fingerprint(guild_index, key:str) -> str:
+    '''
+    Hash of every path, size and mtime below key, taken from the in memory index
+    '''
+    digest = hashlib.sha1()
+    for entry in sorted(guild_index.walk(key), key=lambda entry: entry.path):
+        digest.update(f'{entry.path}\0{entry.is_dir}\0{entry.size}\0{entry.mtime}\n'.encode())
+    return digest.hexdigest()
+
+def build_archive(src:str, dst:str):
+    '''
+    Zip src into dst without compressing (croc compresses on the wire), atomically
+    '''
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    temp = f'{dst}.partial'
+    base = os.path.dirname(os.path.abspath(src))
+    with zipfile.ZipFile(temp, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for dirpath, dirnames, filenames in os.walk(src):
+            dirnames.sort()
+            archive.write(dirpath, os.path.relpath(dirpath, base))
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                archive.write(path, os.path.relpath(path, base))
+    os.replace(temp, dst)
+    return os.path.getsize(dst)
+
+def evict(root:str, budget_bytes:int, keep:set[str]) -> int:
+    '''
+    Delete the least recently used archives until the cache fits in budget_bytes
+    '''
+    archives = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith('.partial'):
+                continue
+            path = os.path.join(dirpath, filename)
+            stat = os.stat(path)
+            archives.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in archives)
+    freed = 0
+    for _, size, path in sorted(archives):
+        if total <= budget_bytes:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+        total -= size
+        freed += size
+    return freed
+
+def drop_stale(path:str, keep:set[str]):
+    '''
+    Remove archives of older fingerprints of the same folder
+    '''
+    folder_dir = os.path.dirname(os.path.dirname(path))
+    if not os.path.isdir(folder_dir):
+        return
+    for fingerprint in os.listdir(folder_dir):
+        fingerprint_dir = os.path.join(folder_dir, fingerprint)
+        if not any(kept.startswith(fingerprint_dir + os.sep) for kept in keep):
+            shutil.rmtree(fingerprint_dir, ignore_errors=True)
+
+class ArchiveCache:
+    '''
+    Pre-built zips of guild folders keyed by a fingerprint of the folder's tree, so /download of a
+    folder can hand croc one ready file instead of having it walk and compress the folder each time.
+    Least recently served archives are evicted once the cache grows past budget_mb.
+    '''
+    def __init__(self, budget_mb:float, root:str = ARCHIVE_ROOT):
+        self.root = root
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self.fs = get_fs_executor()
+        self.logger = get_logger()
+        self.building: dict[str, asyncio.Task] = {}
+        self.in_use: dict[str, int] = {}
+
+    def archive_path(self, guild:str, key:str, fingerprint:str) -> str:
+        folder_id = hashlib.sha1(key.encode()).hexdigest()[:16]
+        name = key.rpartition('/')[2] or guild
+        return os.path.abspath(os.path.join(self.root, guild, folder_id, fingerprint, f'{name}.zip'))
+
+    async def get(self, guild_index, key:str) -> str:
+        '''
+        Path to an up to date archive of key, building it first if needed
+        '''
+        fingerprint = tree_fingerprint(guild_index, key)
+        path = self.archive_path(guild_index.guild, key, fingerprint)
+        if path not in self.building:
+            self.building[path] = asyncio.create_task(self._ensure(guild_index.full_path(key), path))
+            self.building[path].add_done_callback(lambda _: self.building.pop(path, None))
+        await asyncio.shield(self.building[path])
+        return path
+
+    def prebuild(self, guild_index, key:str):
+        asyncio.create_task(self._prebuild(guild_index, key))
+
+    async def _prebuild(self, guild_index, key:str):
+        try:
+            path = await self.get(guild_index, key)
+            self.logger.info(f'ARCHIVE - prebuilt {path}')
+        except Exception as e:
+            self.logger.error(f'ARCHIVE - failed to prebuild {key} in {guild_index.guild}: {e}')
+
+    async def _ensure(self, src:str, path:str):
+        try:
+            await self.fs.run('archive_touch', os.utime, path)
+            return
+        except FileNotFoundError:
+            pass
+        await self.fs.run('archive_evict', drop_stale, path, set(self.in_use))
+        start = time.perf_counter()
+        size = await self.fs.run('archive_build', build_archive, src, path)
+        self.logger.info(f'ARCHIVE - built {path} ({size / (1024 * 1024):.2f} MB) in {time.perf_counter() - start:.2f}s')
+        keep = set(self.in_use) | {path}
+        freed = await self.fs.run('archive_evict', evict, self.root, self.budget_bytes, keep)
+        if freed:
+            self.logger.info(f'ARCHIVE - evicted {freed / (1024 * 1024):.2f} MB of archives')
+
+    def acquire(self, path:str):
+        self.in_use[path] = self.in_use.get(path, 0) + 1
+
+    def release(self, path:str):
+        self.in_use[path] -= 1
+        if not self.in_use[path]:
+            del self.in_use[path]
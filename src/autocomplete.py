@@ -0,0 +1,80 @@
+from collections import OrderedDict
+import discord
+from discord import app_commands
+from src.file_index import get_file_index
+from src.utils import get_safe_guild_name
+
+MAX_CHOICES = 25
+MAX_CHOICE_LENGTH = 100
+CACHE_SIZE = 2048
+
+class PathCompleter:
+    '''
+    Answers autocomplete from the in memory file index. Results are memoized per
+    (guild, prefix) and dropped as soon as that guild's index version moves.
+    '''
+    def __init__(self, index=None):
+        self.index = index or get_file_index()
+        self.cache: OrderedDict[tuple, tuple[int, list[str]]] = OrderedDict()
+
+    def complete(self, guild:str, current:str, dirs_only:bool = False) -> list[str]:
+        guild_index = self.index.guild(guild)
+        key = (guild, current.lower(), dirs_only)
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] == guild_index.version:
+            self.cache.move_to_end(key)
+            return cached[1]
+        results = self._complete(guild_index, current, dirs_only)
+        self.cache[key] = (guild_index.version, results)
+        self.cache.move_to_end(key)
+        while len(self.cache) > CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return results
+
+    def _complete(self, guild_index, current:str, dirs_only:bool) -> list[str]:
+        folder = current.strip('/')
+        if current == '' or (current.endswith('/') and guild_index.list_dir(folder) is not None):
+            entries = sorted(guild_index.list_dir(folder) or [], key=lambda entry: (not entry.is_dir, entry.name.lower()))
+        else:
+            # every keystroke lands here, typos are left to the command itself
+            paths = guild_index.search.search(current, limit=MAX_CHOICES * 2 if dirs_only else MAX_CHOICES, fuzzy=False)
+            entries = [guild_index.entries[path] for path in paths]
+        results = []
+        for entry in entries:
+            if dirs_only and not entry.is_dir:
+                continue
+            value = f'{entry.path}/' if entry.is_dir else entry.path
+            if len(value) > MAX_CHOICE_LENGTH:
+                continue
+            results.append(value)
+            if len(results) == MAX_CHOICES:
+                break
+        return results
+
+_COMPLETER = None
+
+def get_path_completer() -> PathCompleter:
+    global _COMPLETER
+    if _COMPLETER is None:
+        _COMPLETER = PathCompleter()
+    return _COMPLETER
+
+async def path_choices(interaction:discord.Interaction, current:str, dirs_only:bool = False, multiple:bool = False) -> list[app_commands.Choice[str]]:
+    '''
+    With multiple set, current is a comma separated list and only its last item is completed
+    '''
+    if interaction.guild is None:
+        return []
+    guild = get_safe_guild_name(interaction.guild.name)
+    await get_file_index().ensure_guild(guild)
+    head = ''
+    if multiple and ',' in current:
+        head, _, current = current.rpartition(',')
+        head = f'{head},'
+        current = current.lstrip()
+    choices = []
+    for path in get_path_completer().complete(guild, current, dirs_only):
+        value = f'{head} {path}' if head else path
+        if len(value) <= MAX_CHOICE_LENGTH:
+            choices.append(app_commands.Choice(name=value, value=value))
+    return choices
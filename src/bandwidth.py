@@ -0,0 +1,85 @@
+from dataclasses import dataclass
+from src.utils import get_config, get_logger
+
+MB = 1024 * 1024
+
+@dataclass(eq=False)
+class Allocation:
+    guild: str
+    size_mb: float
+    rate_mb: float | None
+
+    def describe(self) -> str:
+        return f"{self.rate_mb:.2f} MB/s" if self.rate_mb is not None else "unthrottled"
+
+class BandwidthAllocator:
+    '''
+    Splits the upload bandwidth the bot spends serving /download between transfers, under a global
+    limit and a per-guild one (0 means unlimited). croc only takes its throttle when it starts, so
+    every new transfer is given the limit divided by the transfers the scheduler lets run at once
+    (global_slots, guild_slots per guild) and at least min_mb, but never more than the running
+    ones leave free. Transfers up to small_file_mb are never throttled so they get out of the way
+    quickly.
+    '''
+    def __init__(self, limit_mb:float, guild_limit_mb:float, guild_limits_mb:dict[str, float], min_mb:float, small_file_mb:float, global_slots:int, guild_slots:int):
+        self.limit_mb = limit_mb
+        self.guild_limit_mb = guild_limit_mb
+        self.guild_limits_mb = guild_limits_mb
+        self.min_mb = min_mb
+        self.small_file_mb = small_file_mb
+        self.global_slots = max(global_slots, 1)
+        self.guild_slots = max(guild_slots, 1)
+        self.allocations: set[Allocation] = set()
+        self.logger = get_logger()
+
+    def guild_limit(self, guild:str) -> float | None:
+        return self.guild_limits_mb.get(guild, self.guild_limit_mb) or None
+
+    def allocated_mb(self, guild:str | None = None) -> float:
+        return sum(allocation.rate_mb for allocation in self.allocations if allocation.rate_mb is not None and (guild is None or allocation.guild == guild))
+
+    def _share(self, limit_mb:float, slots:int, holders:list[Allocation]) -> float:
+        free = limit_mb - sum(allocation.rate_mb for allocation in holders)
+        return min(max(limit_mb / slots, self.min_mb), free)
+
+    def allocate(self, guild:str, size_mb:float) -> Allocation:
+        rate = None
+        if size_mb > self.small_file_mb:
+            shaped = [allocation for allocation in self.allocations if allocation.rate_mb is not None]
+            caps = []
+            if self.limit_mb:
+                caps.append(self._share(self.limit_mb, self.global_slots, shaped))
+            guild_limit = self.guild_limit(guild)
+            if guild_limit:
+                caps.append(self._share(guild_limit, self.guild_slots, [allocation for allocation in shaped if allocation.guild == guild]))
+            if caps:
+                rate = min(caps)
+                if rate <= 0:
+                    # only reachable when bandwidth_min_mb is above a fair share, croc can't be throttled to 0
+                    self.logger.warning(f'BANDWIDTH - {guild} - budget used up, starting a {size_mb:.1f} MB transfer at {self.min_mb:.2f} MB/s')
+                    rate = self.min_mb
+        allocation = Allocation(guild, size_mb, rate)
+        self.allocations.add(allocation)
+        if rate is not None:
+            self.logger.debug(f'BANDWIDTH - {guild} - {size_mb:.1f} MB transfer gets {rate:.2f} MB/s, {self.allocated_mb():.2f} MB/s allocated in total')
+        return allocation
+
+    def release(self, allocation:Allocation):
+        self.allocations.discard(allocation)
+
+    def croc_args(self, allocation:Allocation) -> list[str]:
+        '''
+        Global croc flags applying allocation to a sender
+        '''
+        if allocation.rate_mb is None:
+            return []
+        return ['--throttleUpload', str(int(allocation.rate_mb * MB))]
+
+_ALLOCATOR = None
+
+def get_bandwidth_allocator() -> BandwidthAllocator:
+    global _ALLOCATOR
+    if _ALLOCATOR is None:
+        config = get_config()
+        _ALLOCATOR = BandwidthAllocator(config.bandwidth_limit_mb, config.bandwidth_guild_limit_mb, config.bandwidth_guild_limits_mb, config.bandwidth_min_mb, config.small_file_mb, config.max_global_transfers, config.max_active_processes)
+    return _ALLOCATOR
@@ -2,18 +2,73 @@ from datetime import datetime
 import discord
 from discord import app_commands
 from discord.ext import commands
-from src.utils import get_safe_guild_name, get_logger
+from src.autocomplete import path_choices
+from src.content_store import ContentStore
+from src.file_index import get_file_index, relative_key
+from src.fs_executor import get_fs_executor
+from src.metrics import timed_command
+from src.pagination import Pager, PagerView
+from src.quota import MB, get_quota_manager
+from src.utils import get_config, get_safe_guild_name, get_logger
+import asyncio
 import os
 import shutil
 
+LS_FILTER_LIMIT = 500
+LS_PAGE_LINES = 25
+LS_SORTS = ('name', 'size', 'mtime')
+DU_TOP_ENTRIES = 10
+
+def entry_size(guild_index, entry) -> int:
+    return guild_index.tree_size(entry.path) if entry.is_dir else entry.size
+
+def sort_key(guild_index, sort:str):
+    match sort:
+        case 'size':
+            return lambda entry: -entry_size(guild_index, entry)
+        case 'mtime':
+            return lambda entry: -entry.mtime
+        case _:
+            return lambda entry: entry.name
+
+def entry_line(guild_index, entry, prefix_length:int) -> str:
+    if entry.is_dir:
+        return f'{entry.path[prefix_length:]} - [Directory] - Size: {entry_size(guild_index, entry) / MB:.2f} MB'
+    modified_time = datetime.fromtimestamp(entry.mtime).strftime('%Y-%m-%d %H:%M:%S')
+    return f'{entry.path[prefix_length:]} - Size: {entry.size / MB:.2f} MB - Modified: {modified_time}'
+
+def tree_lines(guild_index, key:str, sort:str):
+    '''
+    Lazily walk everything below key, yielding one indented line per entry
+    '''
+    order = sort_key(guild_index, sort)
+    stack = [iter(sorted(guild_index.list_dir(key) or [], key=order))]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            continue
+        indent = '  ' * len(stack)
+        if entry.is_dir:
+            yield f'{indent}{entry.name}/ - {entry_size(guild_index, entry) / MB:.2f} MB'
+            stack.append(iter(sorted(guild_index.list_dir(entry.path) or [], key=order)))
+        else:
+            yield f'{indent}{entry.name} - {entry.size / MB:.2f} MB'
+
 class FileManagementCog(commands.Cog):
     def __init__(self, client):
         self.client = client
+        self.config = get_config()
         self.logger = get_logger()
+        self.index = get_file_index()
+        self.fs = get_fs_executor()
+        self.store = ContentStore() if self.config.content_store_enabled else None
+        self.quota = get_quota_manager()
 
     @app_commands.command(name='mv', description='move a file (don\'t forget the file extension!)')
     @app_commands.describe(target = 'the name of the file to move')
     @app_commands.describe(output = 'the new name of the file')
+    @timed_command('mv')
     async def mv(self, interaction:discord.Interaction, target:str, output:str):
         if interaction.guild is None:
             return
@@ -21,6 +76,7 @@ class FileManagementCog(commands.Cog):
         msg = await ctx.reply('working...', ephemeral=True)
         self.logger.debug(f'INIT - /mv - {interaction.user.global_name} called /mv target:{target} output:{output} in {interaction.guild.name}')
         server = get_safe_guild_name(interaction.guild.name)
+        await self.index.ensure_guild(server)
         base_path = os.path.abspath(f'./files/{server}')
         target_path = os.path.abspath(os.path.join(base_path, target))
         output_path = os.path.abspath(os.path.join(base_path, output))
@@ -28,33 +84,48 @@ class FileManagementCog(commands.Cog):
             self.logger.warning(f'ABUSE - /mv - {interaction.user.global_name} attempted to move outside of server folder\ntarget: {target_path}\narg: {target}\noutput: {output_path}\narg: {output}')
             await msg.edit(content='Invalid file path!')
             return
-        if not os.path.exists(target_path):
+        target_key = relative_key(base_path, target_path)
+        output_key = relative_key(base_path, output_path)
+        if not target_key or not self.index.exists(server, target_key):
             self.logger.info(f'USAGE - FAIL - /mv - {interaction.user.global_name} attempted to move non-existent file: {target_path} to: {output_path}')
             await msg.edit(content=f'Could not find {target} to move!\nCall /ls')
             return
-        if os.path.exists(output_path):
+        if self.index.exists(server, output_key):
             self.logger.info(f'USAGE - FAIL - /mv - {interaction.user.global_name} attempted to move file: {target_path} to existing path: {output_path}')
             await msg.edit(content=f'{output} already exists!\nCall /rm to delete it or rename it first')
             return
         output_dir = os.path.dirname(output_path)
         try:
-            os.makedirs(output_dir, exist_ok=True)
+            await self.fs.run('makedirs', os.makedirs, output_dir, exist_ok=True)
         except Exception as e:
             self.logger.error(f'ERROR - /mv - {interaction.user.global_name} failed to create directories for {output_path}: {e}')
             await msg.edit(content='Failed to create necessary directories for the output file!')
             return
         try:
-            os.rename(target_path, output_path)
+            await self.fs.run('rename', os.rename, target_path, output_path)
+            await self.index.move(server, target_key, output_key)
             self.logger.info(f'USAGE - SUCCESS - /mv - {interaction.user.global_name} moved: {target_path} to: {output_path}')
             await msg.edit(content=f'Moved {target} to {output}')
         except Exception as e:
             self.logger.error(f'ERROR - /mv - {interaction.user.global_name} failed to move {target_path} to {output_path}: {e}')
             await msg.edit(content='Failed to move the file. Please try again.')
 
+    @mv.autocomplete('target')
+    async def mv_target_autocomplete(self, interaction:discord.Interaction, current:str) -> list[app_commands.Choice[str]]:
+        return await path_choices(interaction, current)
+
+    @mv.autocomplete('output')
+    async def mv_output_autocomplete(self, interaction:discord.Interaction, current:str) -> list[app_commands.Choice[str]]:
+        return await path_choices(interaction, current, dirs_only=True)
+
     @app_commands.command(name='ls', description='list downloadable files')
     @app_commands.describe(filter='A sub string to filter results by')
     @app_commands.describe(folder='The folder to list the contents of')
-    async def ls(self, interaction:discord.Interaction, filter: str = '', folder: str = './'):
+    @app_commands.describe(sort='Order entries by name, size (largest first) or modified time (newest first)')
+    @app_commands.describe(tree='Show everything below the folder as a tree with folder sizes (ignored with a filter)')
+    @app_commands.choices(sort=[app_commands.Choice(name=name, value=name) for name in LS_SORTS])
+    @timed_command('ls')
+    async def ls(self, interaction:discord.Interaction, filter: str = '', folder: str = './', sort: str = '', tree: bool = False):
         '''
         List files 
         '''
@@ -62,8 +133,9 @@ class FileManagementCog(commands.Cog):
             return
         ctx = await commands.Context.from_interaction(interaction)
         msg = await ctx.reply('working...', ephemeral=True)
-        self.logger.debug(f'INIT - /ls - {interaction.user.global_name}, filter:{filter}, folder:{folder}, in {interaction.guild.name}')
+        self.logger.debug(f'INIT - /ls - {interaction.user.global_name}, filter:{filter}, folder:{folder}, sort:{sort}, tree:{tree}, in {interaction.guild.name}')
         server = get_safe_guild_name(interaction.guild.name)
+        guild_index = await self.index.ensure_guild(server)
         base_path = os.path.abspath(f'./files/{server}')
         target_path = os.path.abspath(os.path.join(base_path, folder))
 
@@ -72,36 +144,49 @@ class FileManagementCog(commands.Cog):
             await msg.edit(content='Invalid folder path!')
             return
 
-        if not os.path.exists(target_path) or not os.path.isdir(target_path):
+        folder_key = relative_key(base_path, target_path)
+        entries = self.index.list_dir(server, folder_key)
+        if entries is None:
             self.logger.info(f'USAGE - FAIL - /ls - {interaction.user.global_name} attempted to list non-existent folder: {target_path}')
             await msg.edit(content=f'Could not find folder {folder}!\nCall /ls')
             return
 
-        files = os.listdir(target_path)
-        
         if filter:
-            files = [f for f in files if filter.lower() in f.lower()]
+            files = self.index.search(server, filter, limit=LS_FILTER_LIMIT, within=folder_key, fuzzy=False)
+            if sort:
+                files.sort(key=sort_key(guild_index, sort))
+        else:
+            files = sorted(entries, key=sort_key(guild_index, sort or 'name'))
+        prefix_length = len(folder_key) + 1 if folder_key else 0
 
         if len(files) == 0:
             self.logger.info(f'USAGE - SUCCESS - /ls - {interaction.user.global_name} listed empty folder: {target_path} in {interaction.guild.name}')
             await msg.edit(content='No files found')
             return
 
-        file_details = []
-        for file in files:
-            file_path = os.path.join(target_path, file)
-            if os.path.isfile(file_path):
-                size = os.path.getsize(file_path) / (1024 * 1024)
-                modified_time = datetime.fromtimestamp(os.path.getmtime(file_path)).strftime('%Y-%m-%d %H:%M:%S')
-                file_details.append(f'{file} - Size: {size:.2f} MB - Modified: {modified_time}')
-            else:
-                file_details.append(f'{file} - [Directory]')
+        if tree and not filter:
+            header = f'{folder_key or "."}/ - {guild_index.tree_size(folder_key) / MB:.2f} MB'
+            lines = tree_lines(guild_index, folder_key, sort or 'name')
+        else:
+            header = f'{len(files)} entries in {folder_key or "."}/' + (f' matching {filter}' if filter else '')
+            lines = (entry_line(guild_index, file, prefix_length) for file in files)
+        view = PagerView(Pager(lines, LS_PAGE_LINES), header, interaction.user.id, code_block=tree and not filter)
 
         self.logger.info(f'USAGE - SUCCESS - /ls - {interaction.user.global_name} listed folder: {target_path} in {interaction.guild.name}')
-        await msg.edit(content='\n'.join(file_details))
+        if view.single_page:
+            view.stop()
+            await msg.edit(content=view.render())
+            return
+        view.message = msg
+        await msg.edit(content=view.render(), view=view)
+
+    @ls.autocomplete('folder')
+    async def ls_folder_autocomplete(self, interaction:discord.Interaction, current:str) -> list[app_commands.Choice[str]]:
+        return await path_choices(interaction, current, dirs_only=True)
 
     @app_commands.command(name='rm', description='Delete a file or folder')
     @app_commands.describe(file='The file or folder to delete')
+    @timed_command('rm')
     async def rm(self, interaction:discord.Interaction, file: str):
         if interaction.guild is None:
             return
@@ -109,6 +194,7 @@ class FileManagementCog(commands.Cog):
         msg = await ctx.reply('working...', ephemeral=True)
         self.logger.debug(f'INIT - /rm - {interaction.user.global_name}, file:{file} in {interaction.guild.name}')
         server = get_safe_guild_name(interaction.guild.name)
+        await self.index.ensure_guild(server)
         base_path = os.path.abspath(f'./files/{server}')
         target_path = os.path.abspath(os.path.join(base_path, file))
         self.logger.debug(f'RESULT - base_path: {base_path} target_path: {target_path}')
@@ -123,22 +209,75 @@ class FileManagementCog(commands.Cog):
             await msg.edit(content='Invalid file path!')
             return
         
-        if not os.path.exists(target_path):
+        target_key = relative_key(base_path, target_path)
+        entry = self.index.get(server, target_key)
+        if entry is None:
             self.logger.info(f'USAGE - FAIL - /rm - {interaction.user.global_name} attempted to delete non-existent file: {target_path}')
             await msg.edit(content=f'Could not find {file} to delete!\nCall /ls')
             return
         
+        self.index.remove(server, target_key)
+        if self.store is not None:
+            # drops the blobs of files nobody else links to, without reading them or walking the store
+            delete = self.store.remove
+        else:
+            delete = shutil.rmtree if entry.is_dir else os.remove
+        task = self.fs.start_job(server, 'rm', entry.path, interaction.user.id, delete, target_path)
         try:
-            if os.path.isdir(target_path):
-                shutil.rmtree(target_path)
-            else:
-                os.remove(target_path)
+            try:
+                await asyncio.wait_for(asyncio.shield(task), timeout=self.config.rm_foreground_timeout_s)
+            except asyncio.TimeoutError:
+                self.logger.info(f'USAGE - /rm - {interaction.user.global_name} deleting {target_path} in the background')
+                await msg.edit(content=f'Deleting {file} in the background, see /ps')
+                await task
             self.logger.info(f'USAGE - SUCCESS - /rm - {interaction.user.global_name} deleted: {target_path}')
             await msg.edit(content=f'Deleted {file}')
+            if self.store is not None and task.result():
+                # some blobs had no digest on them, only a walk of the store can find them
+                self.fs.start_job(server, 'gc', 'content store', interaction.user.id, self.store.gc)
         except Exception as e:
+            if self.store is not None:
+                self.fs.start_job(server, 'gc', 'content store', interaction.user.id, self.store.gc)
+            await self.index.refresh(server, target_key)
             self.logger.error(f'ERROR - /rm - {interaction.user.global_name} failed to delete {target_path}: {e}')
             await msg.edit(content=f'Failed to delete {file}')
 
+    @rm.autocomplete('file')
+    async def rm_file_autocomplete(self, interaction:discord.Interaction, current:str) -> list[app_commands.Choice[str]]:
+        return await path_choices(interaction, current)
+
+    @app_commands.command(name='du', description='show how much space this server is using')
+    @timed_command('du')
+    async def du(self, interaction:discord.Interaction):
+        if interaction.guild is None:
+            return
+        ctx = await commands.Context.from_interaction(interaction)
+        msg = await ctx.reply('working...', ephemeral=True)
+        self.logger.debug(f'INIT - /du - {interaction.user.global_name} in {interaction.guild.name}')
+        server = get_safe_guild_name(interaction.guild.name)
+        guild_index = await self.index.ensure_guild(server)
+        used = self.quota.used_bytes(server) / MB
+        quota = self.quota.quota_bytes(server)
+        if quota is None:
+            content = f'Used: {used:.2f} MB (no quota)\n'
+        else:
+            content = f'Used: {used:.2f} MB of {quota / MB:.0f} MB ({used * MB / quota * 100:.1f}%)\n'
+        reserved = self.quota.reserved_bytes(server)
+        if reserved:
+            content += f'Reserved by uploads in progress: {reserved / MB:.2f} MB\n'
+        try:
+            content += f'Free disk space: {await self.quota.free_bytes() / MB:.0f} MB\n'
+        except OSError as e:
+            self.logger.error(f'ERROR - /du - failed to read free disk space: {e}')
+        largest = sorted(guild_index.list_dir('') or [], key=lambda entry: guild_index.tree_size(entry.path) if entry.is_dir else entry.size, reverse=True)[:DU_TOP_ENTRIES]
+        if largest:
+            content += '\nLargest:\n'
+            for entry in largest:
+                size = guild_index.tree_size(entry.path) if entry.is_dir else entry.size
+                content += f'\t{entry.name}{"/" if entry.is_dir else ""} - {size / MB:.2f} MB\n'
+        self.logger.info(f'USAGE - SUCCESS - /du - {interaction.user.global_name} checked usage in {interaction.guild.name}')
+        await msg.edit(content=content)
+
 async def setup(client):
   await client.add_cog(FileManagementCog(client))
 
@@ -0,0 +1,86 @@
+import discord
+from discord import app_commands
+from discord.ext import commands
+import time
+from src.metrics import LoopLagMonitor, MetricsServer, get_metrics, timed_command
+from src.utils import format_duration, get_config, get_safe_guild_name, get_logger
+
+MAX_MESSAGE_LENGTH = 2000
+
+class StatsCog(commands.Cog):
+    def __init__(self, client):
+        self.client = client
+        self.config = get_config()
+        self.logger = get_logger()
+        self.metrics = get_metrics()
+        self.lag_monitor = LoopLagMonitor(self.metrics)
+        self.server = MetricsServer(self.metrics, self.config.metrics_host, self.config.metrics_port) if self.config.metrics_endpoint_enabled else None
+
+    async def cog_load(self):
+        self.lag_monitor.start()
+        if self.server is not None:
+            try:
+                await self.server.start()
+            except OSError as e:
+                self.logger.error(f'ERROR - METRICS - could not serve metrics on {self.config.metrics_host}:{self.config.metrics_port}: {e}')
+
+    async def cog_unload(self):
+        self.lag_monitor.stop()
+        if self.server is not None:
+            await self.server.stop()
+
+    @app_commands.command(name='stats', description='show bot latency, transfer and queue statistics')
+    @timed_command('stats')
+    async def stats(self, interaction:discord.Interaction):
+        if interaction.guild is None:
+            raise ValueError("No guild found")
+        ctx = await commands.Context.from_interaction(interaction)
+        msg = await ctx.reply('working...', ephemeral=True)
+        self.logger.debug(f'INIT - /stats - {interaction.user.global_name} called /stats in {interaction.guild.name}')
+        guild = get_safe_guild_name(interaction.guild.name)
+        self.metrics.collect()
+        content = self.summary(guild)
+        if len(content) > MAX_MESSAGE_LENGTH:
+            content = content[:MAX_MESSAGE_LENGTH - 4] + '\n...'
+        await msg.edit(content=content)
+        self.logger.info(f'USAGE - SUCCESS - /stats - {interaction.user.global_name} listed stats in {interaction.guild.name}')
+
+    def summary(self, guild:str) -> str:
+        metrics = self.metrics
+        content = f"Uptime: {format_duration(time.time() - metrics.started)}\n"
+        lag = metrics.loop_lag.series()
+        if lag is not None:
+            content += f"Event loop lag: p50 {lag.quantile(0.5) * 1000:.1f} ms, p99 {lag.quantile(0.99) * 1000:.1f} ms, max {lag.max * 1000:.1f} ms\n"
+
+        content += "\nCommands:\n"
+        for (command,), series in sorted(metrics.command_seconds.values.items()):
+            errors = metrics.commands.get(command=command, outcome='error')
+            content += f"\t/{command}: {series.count} calls, p50 {series.quantile(0.5) * 1000:.0f} ms, p99 {series.quantile(0.99) * 1000:.0f} ms, {errors:.0f} errors\n"
+
+        content += "\nTransfers:\n"
+        for operation in ('upload', 'download'):
+            outcomes = {key[1]: value for key, value in metrics.transfers.values.items() if key[0] == operation}
+            moved = metrics.transfer_bytes.get(operation=operation) / (1024 * 1024)
+            content += f"\t{operation}: {', '.join(f'{count:.0f} {outcome}' for outcome, count in sorted(outcomes.items())) or 'none'}, {moved:.1f} MB moved"
+            speed = metrics.transfer_speed.series(operation=operation)
+            if speed is not None:
+                content += f", p50 {speed.quantile(0.5):.2f} MB/s"
+            content += "\n"
+        code = metrics.code_seconds.series()
+        if code is not None:
+            content += f"\tcode shown after: p50 {code.quantile(0.5):.2f}s, p99 {code.quantile(0.99):.2f}s\n"
+
+        active = sum(metrics.active_transfers.values.values())
+        queued = sum(metrics.queued_transfers.values.values())
+        content += f"\nThis server: {metrics.active_transfers.values.get((guild,), 0)} active, {metrics.queued_transfers.values.get((guild,), 0)} queued, {metrics.transfer_rate.values.get((guild,), 0):.2f} MB/s\n"
+        content += f"All servers: {active} active, {queued} queued, {sum(metrics.transfer_rate.values.values()):.2f} MB/s\n"
+
+        slowest = sorted(metrics.fs_seconds.values.items(), key=lambda item: item[1].quantile(0.99), reverse=True)[:5]
+        if slowest:
+            content += "\nSlowest filesystem operations:\n"
+            for (operation,), series in slowest:
+                content += f"\t{operation}: {series.count} calls, p99 {series.quantile(0.99) * 1000:.1f} ms, max {series.max * 1000:.1f} ms, {metrics.fs_errors.get(operation=operation):.0f} errors\n"
+        return content
+
+async def setup(client):
+  await client.add_cog(StatsCog(client))
@@ -5,19 +5,73 @@ import asyncio
 from datetime import datetime
 import os
 import re
-from src.utils import Config, convert_to_mb, format_time_difference, get_safe_guild_name, get_logger
+import shutil
+import time
+from src.archive_cache import ArchiveCache
+from src.autocomplete import path_choices
+from src.bandwidth import get_bandwidth_allocator
+from src.content_store import ContentStore, MergeConflict, merge_into, new_staging_dir
+from src.croc import CodeEvent, CrocSession, DoneEvent, ErrorEvent, ProgressEvent, PromptEvent, SendingEvent
+from src.file_index import drop_nested, get_file_index, is_glob, relative_key
+from src.fs_executor import get_fs_executor
+from src.journal import get_transfer_journal
+from src.metrics import get_metrics, timed_command
+from src.progress import MessageUpdater, TransferStats
+from src.quota import QuotaExceeded, get_quota_manager
+from src.relay import RelaySupervisor
+from src.scheduler import TransferScheduler
+from src.transfer_workers import croc_session, get_transfer_workers
+from src.utils import format_time_difference, get_config, get_safe_guild_name, get_logger
+from src.warm_pool import WarmPool
 
-CONFIG = Config.from_json()
 CODE_REGEX = re.compile(r"^[a-zA-Z0-9]+(-[a-zA-Z0-9]+)*$")
+MAX_DOWNLOAD_PATHS = 100
+MAX_LABEL_LENGTH = 200
 
 class FileTransferCog(commands.Cog):
     def __init__(self, client):
         self.client = client
+        self.config = get_config()
         self.processes = {}
         self.logger = get_logger()
+        self.index = get_file_index()
+        self.fs = get_fs_executor()
+        self.metrics = get_metrics()
+        self.archives = ArchiveCache(self.config.archive_cache_budget_mb) if self.config.archive_cache_enabled else None
+        self.relay = RelaySupervisor(self.config.croc_path, self.config.relay_host, self.config.relay_ports, self.config.relay_password, self.config.relay_public_address, self.config.relay_health_interval_s) if self.config.relay_enabled else None
+        self.warm_pool = WarmPool(self.croc_command, self.config.warm_pool_top_k, self.config.warm_pool_min_requests, self.config.warm_pool_idle_s, self.config.warm_pool_interval_s) if self.config.warm_pool_enabled else None
+        self.store = ContentStore() if self.config.content_store_enabled else None
+        self.quota = get_quota_manager()
+        self.scheduler = TransferScheduler(self.config.max_active_processes, self.config.max_global_transfers, self.config.small_file_mb, self.config.queue_aging_s)
+        self.workers = get_transfer_workers()
+        self.journal = get_transfer_journal()
+        self.bandwidth = get_bandwidth_allocator()
+
+    async def cog_load(self):
+        self.metrics.collectors.append(self.collect_metrics)
+        if self.relay is not None:
+            self.relay.start()
+
+    async def cog_unload(self):
+        self.metrics.collectors.remove(self.collect_metrics)
+        if self.warm_pool is not None:
+            self.warm_pool.stop()
+        if self.relay is not None:
+            await self.relay.stop()
+        if self.workers is not None:
+            await self.workers.stop()
+
+    def croc_command(self, relay:bool = True) -> list[str]:
+        '''
+        croc plus the flags pointing it at the bot's own relay when that is up, unless relay is off
+        '''
+        if self.relay is None or not relay:
+            return [self.config.croc_path]
+        return [self.config.croc_path, *self.relay.client_args()]
 
     @app_commands.command(name='upload', description='Upload a file to the bot')
     @app_commands.describe(code = "The code croc gave you")
+    @timed_command('upload')
     async def upload(self, interaction:discord.Interaction, code:str):
         if interaction.guild is None:
             raise ValueError("No guild found")
@@ -29,74 +83,175 @@ class FileTransferCog(commands.Cog):
             return
         self.logger.debug(f'INIT - /upload - {interaction.user.global_name} called /upload code:{code} in {interaction.guild.name}')
         guild = get_safe_guild_name(interaction.guild.name)
+        await self.index.ensure_guild(guild)
         self.init_guild_in_processes(guild)
-        if len(self.processes[guild]) > CONFIG.max_active_processes:
-            await msg.edit(content="Too many active processes. Please try again later.")
-            self.logger.info(f'USAGE - FAIL - /upload - {interaction.user.global_name} too many active processes in {interaction.guild.name} max_processes:{CONFIG.max_active_processes}, active_processes:{len(self.processes[guild])}')
-            return
-        args = [CONFIG.croc_path,"--overwrite", "--out", f"./files/{guild}/", code]
+        async with self.scheduler.slot(guild, interaction.user.id, on_position=self.show_queue_position(msg)):
+            if await self.run_upload(interaction, msg, guild, code):
+                # codes from a plain `croc send` only exist on the public relay
+                await self.run_upload(interaction, msg, guild, code, relay=False)
+
+    async def run_upload(self, interaction:discord.Interaction, msg, guild:str, code:str, relay:bool = True) -> bool:
+        '''
+        Receive code into the guild folder. Returns True when croc could not find the code on the
+        bot's relay, so the caller can try the public one.
+        '''
+        started = time.time()
+        # uploads land in a staging folder and are only moved into the guild folder once croc succeeded
+        out_dir = await self.fs.run('makedirs', new_staging_dir, guild)
+        command = self.croc_command(relay)
+        relayed = len(command) > 1
+        args = [*command, "--overwrite", "--out", out_dir, code]
         self.logger.debug(f'RUN - /upload - {interaction.user.global_name} running: {args}')
-        process = await asyncio.create_subprocess_exec(
-            *args,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            stdin=asyncio.subprocess.PIPE,
-        )
-        pid = process.pid
+        try:
+            session = await croc_session(args, stdin=True).start()
+        except Exception:
+            await self.fs.run('rmtree', shutil.rmtree, out_dir, ignore_errors=True)
+            raise
+        pid = session.pid
+        journal_id = self.journal.begin('upload', guild, pid=pid, args=args, staging=out_dir, owner=interaction.user.id)
         self.logger.debug(f'RUN - /upload - subprocess started with pid: {pid}')
+        stats = TransferStats()
+        updater = MessageUpdater(msg, self.config.progress_edit_interval_s)
         self.processes[guild][pid] = {
             'file': 'unknown',
             'time': datetime.now(),
             'owner': interaction.user.id,
-            'process': process,
+            'process': session.process,
             'operation': 'upload',
             'cancelled': False,
-            'active': True
+            'active': True,
+            'stats': stats
         }
-        file_size_mb = None
         file_name = ""
-        if process.stdin is None or process.stderr is None:
-            if process.returncode is None:
-                process.terminate()
-            self.logger.error(f'ERROR - /upload - {interaction.user.global_name} failed to start process with pid: {pid}')
-            return
+        outcome = None
+        reservation = None
+        def show_progress(event):
+            stats.on_event(event)
+            if isinstance(event, ProgressEvent):
+                updater.update(f"Uploading {file_name}: {stats.describe()}")
+        session.listeners.append(show_progress)
         try:
-            file_name, file_size_mb = await self.get_name_and_size_from_croc(process)
+            event = await session.wait_for(PromptEvent)
+            if not isinstance(event, PromptEvent):
+                self.logger.error(f'ERROR - /upload - {interaction.user.global_name} croc {pid} ended before asking to accept: {event}')
+                outcome = 'fail'
+                if relayed and pid in self.processes[guild]:
+                    self.logger.info(f'USAGE - /upload - {interaction.user.global_name} code not found on the relay, retrying on the public relay')
+                    self.processes[guild][pid]['cancelled'] = True
+                    await msg.edit(content="Code not found on the bot's relay, trying the public relay...")
+                    return True
+                self.processes[guild][pid]['cancelled'] = True
+                content = "Upload failed, check your code and try again."
+                if self.relay is not None:
+                    content += f"\nSend through the bot's relay with: {self.relay.send_hint()}"
+                await msg.edit(content=content)
+                return
+            file_name = event.name
             self.processes[guild][pid]['file'] = file_name
-            if file_size_mb is not None:
-                if file_size_mb <= CONFIG.max_file_size_mb:
-                    self.logger.info(f"USAGE - SUCCESS - /upload - {interaction.user.global_name} File {file_name} is {file_size_mb} MB")
-                    process.stdin.write(b'y\n')
-                    await msg.edit(content="Uploading file...")
-                else:
-                    self.logger.info(f"USAGE - FAIL - /upload - {interaction.user.global_name} File {file_name} exceeds upload limit of {CONFIG.max_file_size_mb} MB")
-                    self.logger.debug(f"EXITING - /upload - {pid} - CANCELLING UPLOAD")
-                    process.stdin.write(b'n\n')
-                    await msg.edit(content=f"File exceeds upload limit of {CONFIG.max_file_size_mb} MB")
-                    self.processes[guild].pop(pid)
-                    await process.wait()
-                    self.logger.debug(f"EXITING - /upload - {pid} - PROCESS AWAITED")
-                    if process.returncode is None:
-                        self.logger.debug(f"EXITING - /upload - {pid} - PROCESS TERMINATED")
-                        process.terminate()
-                    else:
-                        self.logger.debug(f"EXITING - /upload - {pid} - PROCESS EXITED GRACEFULLY")
-                    return
+            self.journal.update(journal_id, file=file_name)
+            refusal = None
+            if event.size_mb > self.config.max_file_size_mb:
+                refusal = f"File exceeds upload limit of {self.config.max_file_size_mb} MB"
+            else:
+                try:
+                    reservation = await self.quota.reserve(guild, int(event.size_mb * 1024 * 1024))
+                except QuotaExceeded as e:
+                    refusal = str(e)
+            if refusal is None:
+                self.logger.info(f"USAGE - SUCCESS - /upload - {interaction.user.global_name} File {file_name} is {event.size_mb} MB")
+                await session.answer(True)
+                await msg.edit(content="Uploading file...")
+            else:
+                self.logger.info(f"USAGE - FAIL - /upload - {interaction.user.global_name} File {file_name} ({event.size_mb} MB) refused: {refusal}")
+                self.logger.debug(f"EXITING - /upload - {pid} - CANCELLING UPLOAD")
+                await session.answer(False)
+                self.processes[guild][pid]['cancelled'] = True
+                outcome = 'rejected'
+                await msg.edit(content=refusal)
+                return
             self.logger.debug(f"EXECUTING - /upload - {pid} - AWAITING UPLOAD PROCESS")
-            await process.wait()
+            event = await session.wait_for(DoneEvent)
+            while isinstance(event, ErrorEvent):
+                self.logger.error(f'ERROR - /upload - {pid} - croc reported: {event.message}')
+                event = await session.wait_for(DoneEvent)
             self.logger.debug(f"EXECUTING - /upload - {pid} - PROCESS UPLOAD AWAITED")
         finally:
-            if not self.processes[guild][pid]['cancelled']:
-                await msg.edit(content="File uploaded!")
-            if process.returncode is None:
-                self.logger.debug(f"EXITING - /upload - {pid} - PROCESS TERMINATED")
-                process.terminate()
-            else:
-                self.logger.debug(f"EXITING - /upload - {pid} - PROCESS EXITED GRACEFULLY")
-            self.processes[guild].pop(pid)
+            failure = None
+            kept = False
+            try:
+                await updater.close()
+                if session.returncode is None:
+                    self.logger.debug(f"EXITING - /upload - {pid} - PROCESS TERMINATED")
+                else:
+                    self.logger.debug(f"EXITING - /upload - {pid} - PROCESS EXITED GRACEFULLY")
+                await session.close()
+                if session.returncode == 0:
+                    self.journal.update(journal_id, received=True)
+                    await self.journal.flush()
+                try:
+                    # a failed upload never left staging, only what was moved into the guild folder changed
+                    for name in await self.promote_upload(interaction, guild, out_dir, session.returncode == 0):
+                        await self.index.refresh(guild, name)
+                except MergeConflict as e:
+                    self.logger.info(f"USAGE - FAIL - /upload - {interaction.user.global_name} File {file_name} could not be saved: {e}")
+                    outcome = 'fail'
+                    failure = f"Upload failed, {e}."
+                except OSError as e:
+                    self.logger.error(f'ERROR - /upload - {pid} - could not move {file_name} into place, keeping it for the next start: {e}')
+                    outcome = 'fail'
+                    failure = "Upload failed to save, it will be retried when the bot restarts."
+                    kept = True
+                if self.archives is not None and session.returncode == 0 and failure is None:
+                    self.prebuild_archives(guild, started)
+            finally:
+                if reservation is not None:
+                    self.quota.release(reservation)
+                outcome = outcome or self.transfer_outcome(guild, pid, session)
+                if not kept:
+                    # a kept entry stays open with received set so recover() finishes the move
+                    self.journal.end(journal_id, outcome)
+                self.record_transfer('upload', outcome, stats, time.time() - started)
+                try:
+                    if pid in self.processes[guild] and not self.processes[guild][pid]['cancelled']:
+                        await msg.edit(content=failure or ("File uploaded!" if session.returncode == 0 else "Upload failed!"))
+                finally:
+                    self.processes[guild].pop(pid, None)
+        return False
+
+    def prebuild_archives(self, guild:str, since:float):
+        '''
+        Build archives for folders the upload just touched so the first /download is instant
+        '''
+        for entry in self.index.list_dir(guild, '') or []:
+            if entry.is_dir and entry.mtime >= since - 1:
+                self.archives.prebuild(self.index.guild(guild), entry.path)
+
+    async def promote_upload(self, interaction:discord.Interaction, guild:str, staging:str, succeeded:bool) -> list[str]:
+        '''
+        Move a finished upload into the guild folder, deduplicated against the content store if enabled.
+        Returns the top-level names that were moved. The staging folder is dropped unless moving it
+        failed part way, then it is left for the journal to finish on the next start.
+        '''
+        if not succeeded:
+            await self.fs.run('rmtree', shutil.rmtree, staging, ignore_errors=True)
+            return []
+        try:
+            if self.store is not None:
+                saved = await self.fs.run('dedup', self.store.ingest_tree, staging)
+                self.logger.info(f'STORE - /upload - {interaction.user.global_name} upload in {guild} deduplicated, saved {saved / (1024 * 1024):.2f} MB')
+            names = await self.fs.run('promote', merge_into, staging, f'./files/{guild}')
+        except MergeConflict:
+            # nothing was moved
+            await self.fs.run('rmtree', shutil.rmtree, staging, ignore_errors=True)
+            raise
+        await self.fs.run('rmtree', shutil.rmtree, staging, ignore_errors=True)
+        if self.store is not None:
+            self.fs.start_job(guild, 'gc', 'content store', interaction.user.id, self.store.gc)
+        return names
 
     @app_commands.command(name='download', description='Download a file from the bot')
-    @app_commands.describe(file = "The name of the file")
+    @app_commands.describe(file = "The name of the file, several separated by commas, or a pattern like builds/*.zip")
+    @timed_command('download')
     async def download(self, interaction:discord.Interaction, file:str):
         if interaction.guild is None:
             raise ValueError("No guild found")
@@ -104,89 +259,186 @@ class FileTransferCog(commands.Cog):
         msg = await ctx.reply('working...', ephemeral=True)
         self.logger.debug(f'INIT - /download - {interaction.user.global_name} called /download file:{file} in {interaction.guild.name}')
         guild = get_safe_guild_name(interaction.guild.name)
+        await self.index.ensure_guild(guild)
         self.init_guild_in_processes(guild)
-        if len(self.processes[guild]) > CONFIG.max_active_processes:
-            await msg.edit(content="Too many active processes. Please try again later.")
-            self.logger.info(f'USAGE - FAIL - /download - {interaction.user.global_name} too many active processes in {interaction.guild.name} max_processes:{CONFIG.max_active_processes}, active_processes:{len(self.processes[guild])}')
         base_path = os.path.abspath(f'./files/{guild}')
-        target_path = os.path.abspath(os.path.join(base_path, file))
-        if not target_path.startswith(base_path):
-            self.logger.warning(f'ABUSE - /download - {interaction.user.global_name} attempted to access outside of guild folder\ntarget: {target_path}\narg: {file}')
-            await msg.edit(content='Invalid file path!')
+        entries = []
+        # a file whose name holds commas is downloaded as is rather than split into several
+        whole = file.strip()
+        if whole and self.index.get(guild, relative_key(base_path, os.path.abspath(os.path.join(base_path, whole)))) is not None:
+            names = [whole]
+        else:
+            names = [name.strip() for name in file.split(',') if name.strip()]
+        for name in names:
+            target_path = os.path.abspath(os.path.join(base_path, name))
+            if not target_path.startswith(base_path):
+                self.logger.warning(f'ABUSE - /download - {interaction.user.global_name} attempted to access outside of guild folder\ntarget: {target_path}\narg: {name}')
+                await msg.edit(content='Invalid file path!')
+                return
+            matches = self.resolve(guild, base_path, target_path, name)
+            if not matches:
+                await msg.edit(content=f'Could not find {name}!\nCall /ls')
+                self.logger.info(f'USAGE - FAIL - /download - {interaction.user.global_name} could not find file: {name}')
+                return
+            entries.extend(matches)
+        entries = drop_nested(entries)
+        if not entries:
+            await msg.edit(content='Give the name of a file to download')
             return
-        if not os.path.exists(f"./files/{guild}/{file}"):
-            files = os.listdir(f'./files/{guild}')
-            for f in files:
-                if file.lower() in f.lower():
-                    file = f
-        file_size_mb = os.path.getsize(f'./files/{guild}/{file}') / (1024 * 1024)
-        if file_size_mb > CONFIG.max_file_size_mb:
-            await msg.edit(content=f"File exceeds download limit of {CONFIG.max_file_size_mb} MB")
-            self.logger.info(f"USAGE - FAIL - /download - {interaction.user.global_name} File {file} exceeds download limit of {CONFIG.max_file_size_mb} MB")
+        if len(entries) > MAX_DOWNLOAD_PATHS:
+            await msg.edit(content=f'That matches {len(entries)} files, download at most {MAX_DOWNLOAD_PATHS} at once (or download their folder)')
+            self.logger.info(f'USAGE - FAIL - /download - {interaction.user.global_name} requested {len(entries)} paths')
             return
-        self.logger.debug(f"RUN - /download - {interaction.user.global_name} starting croc for file: {file}")
-        process = await asyncio.create_subprocess_exec(
-            CONFIG.croc_path,"--yes", "send", f"./files/{guild}/{file}",
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        pid = process.pid
+        names = [entry.name for entry in entries]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            await msg.edit(content=f'Several of the selected files are named {", ".join(duplicates)}, download those separately')
+            return
+        guild_index = self.index.guild(guild)
+        file_size_mb = sum(guild_index.tree_size(entry.path) if entry.is_dir else entry.size for entry in entries) / (1024 * 1024)
+        label = entries[0].path if len(entries) == 1 else f'{len(entries)} files: {", ".join(entry.path for entry in entries)}'
+        if len(label) > MAX_LABEL_LENGTH:
+            label = label[:MAX_LABEL_LENGTH - 3] + '...'
+        if file_size_mb > self.config.max_file_size_mb:
+            await msg.edit(content=f"File exceeds download limit of {self.config.max_file_size_mb} MB")
+            self.logger.info(f"USAGE - FAIL - /download - {interaction.user.global_name} File {label} exceeds download limit of {self.config.max_file_size_mb} MB")
+            return
+        async with self.scheduler.slot(guild, interaction.user.id, file_size_mb, on_position=self.show_queue_position(msg)):
+            await self.run_download(interaction, msg, guild, entries, label, file_size_mb)
+
+    def resolve(self, guild:str, base_path:str, target_path:str, name:str) -> list:
+        '''
+        Entries a /download argument refers to: an exact path (even one holding * or ?), a glob, or
+        failing that the best search match
+        '''
+        key = relative_key(base_path, target_path)
+        entry = self.index.get(guild, key)
+        if entry is None and is_glob(name):
+            return self.index.guild(guild).glob(key)
+        if entry is None:
+            matches = self.index.search(guild, name, limit=1)
+            if matches:
+                entry = matches[0]
+                self.logger.debug(f'RESULT - /download - resolved {name} to {entry.path}')
+        return [entry] if entry is not None else []
+
+    async def run_download(self, interaction:discord.Interaction, msg, guild:str, entries:list, label:str, file_size_mb:float):
+        send_paths = []
+        archives = []
+        for entry in entries:
+            send_path = f"./files/{guild}/{entry.path}"
+            if entry.is_dir and self.archives is not None:
+                await msg.edit(content="Preparing folder...")
+                try:
+                    archive = await self.archives.get(self.index.guild(guild), entry.path)
+                    self.archives.acquire(archive)
+                    archives.append(archive)
+                    send_path = archive
+                except Exception as e:
+                    self.logger.error(f'ERROR - /download - failed to build archive of {entry.path}, sending the folder instead: {e}')
+            send_paths.append(send_path)
+        single = entries[0] if len(entries) == 1 else None
+        snapshot = None if single is None or archives else (single.size, single.mtime)
+        warmable = single is not None and (bool(archives) or not single.is_dir)
+        try:
+            await self.serve(interaction, msg, guild, label, file_size_mb, send_paths, snapshot, warmable)
+        finally:
+            for archive in archives:
+                self.archives.release(archive)
+
+    async def serve(self, interaction:discord.Interaction, msg, guild:str, file:str, file_size_mb:float, send_paths:list[str], snapshot:tuple | None = None, warmable:bool = False):
+        warm = None
+        allocation = self.bandwidth.allocate(guild, file_size_mb)
+        # warm senders run unthrottled, throttled transfers need a croc of their own
+        if self.warm_pool is not None and warmable and allocation.rate_mb is None:
+            self.warm_pool.start()
+            self.warm_pool.record(guild, send_paths[0], snapshot)
+            warm = self.warm_pool.take(guild, send_paths[0], snapshot)
+        try:
+            if warm is not None:
+                session = warm.session
+                self.logger.debug(f"RUN - /download - {interaction.user.global_name} using warm sender {session.pid} for file: {send_paths[0]}")
+            else:
+                self.logger.debug(f"RUN - /download - {interaction.user.global_name} starting croc at {allocation.describe()} for: {send_paths}")
+                session = await croc_session([*self.croc_command(), *self.bandwidth.croc_args(allocation), "--yes", "send", *send_paths]).start()
+        except Exception:
+            self.bandwidth.release(allocation)
+            raise
+        pid = session.pid
+        journal_id = self.journal.begin('download', guild, pid=pid, args=session.args, file=file, owner=interaction.user.id)
         self.logger.debug(f'RUN - /download - subprocess started with pid: {pid}')
+        stats = TransferStats(file_size_mb)
+        updater = MessageUpdater(msg, self.config.progress_edit_interval_s)
         self.processes[guild][pid] = {
             'file': file,
             'time': datetime.now(),
             'owner': interaction.user.id,
-            'process': process,
+            'process': session.process,
             'operation': 'download',
             'cancelled': False,
-            'active': False
+            'active': False,
+            'stats': stats,
+            'allocation': allocation
         }
-
-        file_size = None
         code = None
-
-        if process.stderr is None:
-            if process.returncode is None:
-                process.terminate()
-            self.logger.error(f'ERROR - /download - {interaction.user.global_name} failed to start process with pid: {pid}')
-            return
+        outcome = None
+        started = time.monotonic()
+        def show_progress(event):
+            stats.on_event(event)
+            if isinstance(event, ProgressEvent):
+                updater.update(f"Code: {code}\nSending {file}: {stats.describe()}")
+        session.listeners.append(show_progress)
         try:
-            code, file_size = await self.get_code_from_croc(process)
-            if file_size and code:
-                await msg.edit(content=f"File size: {file_size}\nCode: {code}")
-                self.logger.info(f"USAGE - SUCCESS - /download - {interaction.user.global_name} File size: {file_size}, Code: {code}")
-                while True:
-                    try:
-                        chunk = await asyncio.wait_for(process.stderr.read(1024), timeout=60)
-                    except asyncio.TimeoutError:
-                        process.kill()
-                        self.processes[guild][pid]['cancelled'] = True
-                        await msg.edit(content="Request cancelled!\nEnter the code within 60 seconds of requesting it.")
-                        self.logger.info(f"USAGE - FAIL - /download - {interaction.user.global_name} Request cancelled due to timeout")
-                        break
-                    if not chunk:
-                        continue
-                    if 'Sending' in chunk.decode():
-                        self.processes[guild][pid]['active'] = True
-                        break
+            event = warm.code if warm is not None else await session.wait_for(CodeEvent)
+            if isinstance(event, CodeEvent):
+                code = event.code
+                content = f"File size: {event.size}\nCode: {event.code}"
+                if self.relay is not None and '--relay' in session.args:
+                    content += f"\nReceive with: {self.relay.receive_hint(event.code)}"
+                await msg.edit(content=content)
+                self.metrics.code_seconds.observe(time.monotonic() - started)
+                self.logger.info(f"USAGE - SUCCESS - /download - {interaction.user.global_name} File size: {event.size}, Code: {event.code}")
+                try:
+                    event = await session.wait_for(SendingEvent, timeout=60)
+                except asyncio.TimeoutError:
+                    session.kill()
+                    self.processes[guild][pid]['cancelled'] = True
+                    outcome = 'timeout'
+                    await msg.edit(content="Request cancelled!\nEnter the code within 60 seconds of requesting it.")
+                    self.logger.info(f"USAGE - FAIL - /download - {interaction.user.global_name} Request cancelled due to timeout")
+                    return
+                if isinstance(event, SendingEvent):
+                    self.processes[guild][pid]['active'] = True
+                    event = await session.wait_for(DoneEvent)
+                if isinstance(event, ErrorEvent):
+                    self.logger.error(f"ERROR - /download - {pid} - croc reported: {event.message}")
             else:
                 await msg.edit(content="Failed to extract file size or code.")
-                self.logger.error(f"ERROR - /download - {interaction.user.global_name} Failed to extract file size or code")
-                process.kill()
-            await process.wait()
+                self.logger.error(f"ERROR - /download - {interaction.user.global_name} Failed to extract file size or code: {event}")
+                self.processes[guild][pid]['cancelled'] = True
+                outcome = 'fail'
+                session.kill()
         finally:
-            if not self.processes[guild][pid]['cancelled']:
-                await msg.edit(content="File served!")
-            if process.returncode is None:
+            await updater.close()
+            if session.returncode is None:
                 self.logger.debug(f"EXITING - /download - {pid} - PROCESS TERMINATED")
-                process.terminate()
             else:
                 self.logger.debug(f"EXITING - /download - {pid} - PROCESS EXITED GRACEFULLY")
-            await process.wait()
-            if process in self.processes[guild]:
-                self.processes[guild].pop(pid)
+            await session.close()
+            self.bandwidth.release(allocation)
+            outcome = outcome or self.transfer_outcome(guild, pid, session)
+            self.journal.end(journal_id, outcome)
+            self.record_transfer('download', outcome, stats, time.monotonic() - started)
+            if pid in self.processes[guild] and not self.processes[guild][pid]['cancelled']:
+                await msg.edit(content="File served!" if session.returncode == 0 else "Transfer failed!")
+            self.processes[guild].pop(pid, None)
+
+    @download.autocomplete('file')
+    async def download_file_autocomplete(self, interaction:discord.Interaction, current:str) -> list[app_commands.Choice[str]]:
+        return await path_choices(interaction, current, multiple=True)
 
     @app_commands.command(name='ps', description='list active processes')
+    @timed_command('ps')
     async def ps(self, interaction:discord.Interaction):
         content = ""
         ctx = await commands.Context.from_interaction(interaction)
@@ -204,7 +456,26 @@ class FileTransferCog(commands.Cog):
             content += f"\ttime active: {formatted_time}\n"
             content += f"\toperation: {self.processes[guild][process]['operation']}\n"
             content += f"\tactive: {self.processes[guild][process]['active']}\n"
+            content += f"\tprogress: {self.processes[guild][process]['stats'].describe()}\n"
+            if 'allocation' in self.processes[guild][process]:
+                content += f"\tbandwidth: {self.processes[guild][process]['allocation'].describe()}\n"
             content += f"\tto kill use /kill {i}\n"
+        for i, job in enumerate(self.fs.jobs.get(guild, {}).values()):
+            formatted_time = format_time_difference(job['time'], datetime.now())
+            content += f"\nJob {i}:\n"
+            content += f"\tfile: {job['file']}\n"
+            content += f"\towner: {job['owner']}\n"
+            content += f"\ttime active: {formatted_time}\n"
+            content += f"\toperation: {job['operation']}\n"
+        if self.warm_pool is not None and self.warm_pool.count(guild):
+            content += f"\n{self.warm_pool.count(guild)} warm sender(s) ready for popular files\n"
+        queued = self.scheduler.queued(guild)
+        if queued:
+            content += f"\n{queued} transfer(s) waiting in the queue\n"
+        allocated = self.bandwidth.allocated_mb(guild)
+        if allocated:
+            guild_limit = self.bandwidth.guild_limit(guild)
+            content += f"\n{allocated:.2f} MB/s of upload bandwidth allocated" + (f" out of {guild_limit} MB/s\n" if guild_limit else "\n")
         if content == "":
             content = "No active processes"
         await msg.edit(content=content)
@@ -212,6 +483,7 @@ class FileTransferCog(commands.Cog):
 
     @app_commands.command(name='kill', description='kill a process (use /ps to list)')
     @app_commands.describe(id = "the id of the process to kill")
+    @timed_command('kill')
     async def kill(self, interaction:discord.Interaction, id:int):
         if interaction.guild is None:
             raise ValueError("No guild found")
@@ -234,78 +506,40 @@ class FileTransferCog(commands.Cog):
         await msg.edit(content=f"Process {id} killed.")
         self.logger.info(f'USAGE - SUCCESS - /kill - {interaction.user.global_name} killed process id:{id} in {interaction.guild.name}')
 
-    def init_guild_in_processes(self, guild):
-        if guild not in self.processes:
-            self.processes[guild] = {}
-
-    async def get_name_and_size_from_croc(self, process):
-        buffer = ""
-        file_name = ""
-        file_size_mb = 0.0
-        pid = process.pid
+    def transfer_outcome(self, guild:str, pid:int, session:CrocSession) -> str:
+        if pid not in self.processes[guild]:
+            return 'killed'
+        return 'success' if session.returncode == 0 else 'fail'
 
-        self.logger.debug(f"RUN - /upload - reading process for pid: {pid}")
-        i = 0
-        while True:
-            i += 1
-            chunk = await process.stderr.read(1024)
-            if not chunk:
-                self.logger.debug(f"RUN - /upload - chunk {i} is falsey, breaking")
-                break
-            self.logger.debug(f"RUN - /upload - found chunk {i}")
-            buffer += chunk.decode()
-            
-            match = re.search(r"Accept '(.+)' \(([\d.]+) (kB|MB|GB|B|TB)\)\? \(Y/n\)", buffer)
-            if match:
-                self.logger.debug(f"RUN - /upload - chunk {i} matched file size and name")
-                file_name = match.group(1)
-                size = float(match.group(2))
-                unit = match.group(3)
-                file_size_mb = convert_to_mb(size, unit)
-                buffer = ""
-                break
-            
-            match = re.search(r"Accept (\d+) files? and (\d+) folders? \(([\d.]+) (kB|MB|GB|B|TB)\)\? \(Y/n\)", buffer)
-            if match:
-                self.logger.debug(f"RUN - /upload - chunk {i} matched multiple files/folders")
-                file_name = "folder"
-                size = float(match.group(3))
-                unit = match.group(4)
-                file_size_mb = convert_to_mb(size, unit)
-                buffer = ""
-                break
+    def record_transfer(self, operation:str, outcome:str, stats:TransferStats, elapsed:float):
+        self.metrics.transfers.inc(operation=operation, outcome=outcome)
+        self.metrics.transfer_bytes.inc(stats.transferred_mb * 1024 * 1024, operation=operation)
+        if outcome == 'success':
+            self.metrics.transfer_seconds.observe(elapsed, operation=operation)
+            if stats.average_mb:
+                self.metrics.transfer_speed.observe(stats.average_mb, operation=operation)
 
-        return file_name, file_size_mb
+    def collect_metrics(self, metrics):
+        metrics.active_transfers.clear()
+        metrics.queued_transfers.clear()
+        metrics.transfer_rate.clear()
+        for guild in set(self.scheduler.active) | {ticket.guild for ticket in self.scheduler.waiting}:
+            metrics.active_transfers.set(self.scheduler.active.get(guild, 0), guild=guild)
+            metrics.queued_transfers.set(self.scheduler.queued(guild), guild=guild)
+        for guild, processes in self.processes.items():
+            metrics.transfer_rate.set(sum(process['stats'].speed_mb for process in processes.values() if process['active']), guild=guild)
 
-    async def get_code_from_croc(self, process):
-        buffer = ""
-        file_size = None
-        code = None
-        pid = process.pid
-
-        self.logger.debug(f"RUN - /download - reading process for pid: {pid}")
-        i = 0
-        while True:
-            i += 1
-            chunk = await process.stderr.read(1024)
-            if not chunk:
-                self.logger.debug(f"RUN - /download - chunk {i} is falsey, breaking")
-                break
-            self.logger.debug(f"RUN - /download - found chunk {i}")
-            buffer += chunk.decode()
-            size_match = re.search(r"Sending .* \((.*)\)", buffer)
-            if size_match:
-                self.logger.debug(f"RUN - /download - chunk {i} matched file size")
-                file_size = size_match.group(1)
-            code_match = re.search(r"Code is: (.*)", buffer)
-            if code_match:
-                self.logger.debug(f"RUN - /download - chunk {i} matched code")
-                code = code_match.group(1)
-            if file_size and code:
-                self.logger.debug(f"RUN - /download - chunk {i} matched both file size and code, breaking")
-                break
+    def show_queue_position(self, msg):
+        async def edit(position:int):
+            try:
+                await msg.edit(content=f"Waiting for a free transfer slot, you are number {position} in the queue...")
+            except discord.HTTPException as e:
+                self.logger.debug(f'QUEUE - failed to update queue position message: {e}')
+        return edit
 
-        return code, file_size
+    def init_guild_in_processes(self, guild):
+        if guild not in self.processes:
+            self.processes[guild] = {}
 
 async def setup(client):
   await client.add_cog(FileTransferCog(client))
@@ -0,0 +1,208 @@
+import errno
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+from src.utils import get_logger
+
+STORE_ROOT = './files/.store'
+STAGING_ROOT = './files/.staging'
+CHUNK_SIZE = 1024 * 1024
+# the blob's digest, stored on the inode so every link to it carries it
+DIGEST_XATTR = 'user.float.sha256'
+
+def hash_file(path:str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_digest(path:str) -> str | None:
+    try:
+        return os.getxattr(path, DIGEST_XATTR, follow_symlinks=False).decode()
+    except (AttributeError, OSError):
+        # no xattr support on this platform or filesystem, or a blob from before digests were kept
+        return None
+
+def write_digest(path:str, digest:str):
+    try:
+        os.setxattr(path, DIGEST_XATTR, digest.encode())
+    except (AttributeError, OSError):
+        pass
+
+class MergeConflict(OSError):
+    pass
+
+def check_merge(src:str, dst:str):
+    '''
+    Raise MergeConflict if anything under src would land on a path of the other type (file vs folder) in dst
+    '''
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel = os.path.relpath(dirpath, src)
+        target_dir = os.path.join(dst, rel)
+        for dirname in dirnames:
+            target = os.path.join(target_dir, dirname)
+            if os.path.lexists(target) and not os.path.isdir(target):
+                raise MergeConflict(f'{os.path.normpath(os.path.join(rel, dirname))} already exists as a file')
+        for filename in filenames:
+            target = os.path.join(target_dir, filename)
+            if os.path.isdir(target):
+                raise MergeConflict(f'{os.path.normpath(os.path.join(rel, filename))} already exists as a folder')
+
+def merge_into(src:str, dst:str) -> list[str]:
+    '''
+    Move everything under src into dst, replacing files that already exist (like croc --overwrite)
+    and merging directories. Returns the top-level names that were moved. Nothing is moved when
+    the merge would conflict.
+    '''
+    check_merge(src, dst)
+    names = os.listdir(src)
+    for dirpath, dirnames, filenames in os.walk(src):
+        target_dir = os.path.join(dst, os.path.relpath(dirpath, src))
+        os.makedirs(target_dir, exist_ok=True)
+        for filename in filenames:
+            os.replace(os.path.join(dirpath, filename), os.path.join(target_dir, filename))
+    return names
+
+def new_staging_dir(guild:str) -> str:
+    path = os.path.join(STAGING_ROOT, guild, uuid.uuid4().hex)
+    os.makedirs(path)
+    return path
+
+class ContentStore:
+    '''
+    Keeps one blob per sha256 under ./files/.store and hardlinks it into each guild's folder.
+    A blob's link count is its reference count: /rm drops a link and the blob with the last one,
+    /mv keeps it, and gc() deletes blobs nobody links to anymore (like ones an upload overwrote).
+    Lives on the same volume as ./files so links work.
+    '''
+    def __init__(self, root:str = STORE_ROOT):
+        self.root = root
+        self.logger = get_logger()
+        self._gc_lock = threading.Lock()
+        self._gc_running = False
+        self._gc_again = False
+
+    def blob_path(self, digest:str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def ingest(self, path:str) -> int:
+        '''
+        Replace path with a link to its blob, returns the bytes saved
+        '''
+        stat = os.stat(path)
+        if stat.st_nlink > 1:
+            return 0
+        digest = hash_file(path)
+        blob = self.blob_path(digest)
+        try:
+            blob_stat = os.stat(blob)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.link(path, blob)
+            write_digest(blob, digest)
+            return 0
+        if read_digest(blob) is None:
+            write_digest(blob, digest)
+        if blob_stat.st_ino == stat.st_ino:
+            return 0
+        temp = f'{path}.{uuid.uuid4().hex}.dedup'
+        try:
+            os.link(blob, temp)
+        except FileNotFoundError:
+            # collected by gc() since the stat above, this file becomes the blob instead
+            os.link(path, blob)
+            write_digest(blob, digest)
+            return 0
+        os.replace(temp, path)
+        return stat.st_size
+
+    def ingest_tree(self, path:str) -> int:
+        saved = 0
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                file_path = os.path.join(dirpath, filename)
+                try:
+                    saved += self.ingest(file_path)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                        raise
+                    self.logger.warning(f'STORE - could not link {file_path}, keeping a private copy: {e}')
+        return saved
+
+    def remove(self, path:str) -> bool:
+        '''
+        Delete a file or folder, and the blob of every file whose last link outside the store goes
+        with it. Blobs are found from the digest kept on their inode, returns True when one had none
+        and only gc() can collect it.
+        '''
+        if not os.path.isdir(path) or os.path.islink(path):
+            return self.remove_file(path)
+        unknown = False
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                unknown |= self.remove_file(os.path.join(dirpath, filename))
+        shutil.rmtree(path)
+        return unknown
+
+    def remove_file(self, path:str) -> bool:
+        stat = os.lstat(path)
+        digest = None
+        if stat.st_nlink == 2 and os.path.isfile(path) and not os.path.islink(path):
+            digest = read_digest(path)
+            if digest is None:
+                os.remove(path)
+                return True
+        os.remove(path)
+        if digest is None:
+            return False
+        blob = self.blob_path(digest)
+        try:
+            blob_stat = os.stat(blob)
+            if blob_stat.st_ino == stat.st_ino and blob_stat.st_nlink == 1:
+                os.remove(blob)
+        except FileNotFoundError:
+            pass
+        return False
+
+    def gc(self) -> int:
+        '''
+        Delete blobs with no links left outside the store, returns the bytes freed. Only one gc runs
+        at a time, a call made while one is running has it walk the store once more instead.
+        '''
+        with self._gc_lock:
+            if self._gc_running:
+                self._gc_again = True
+                return 0
+            self._gc_running = True
+        freed = 0
+        try:
+            while True:
+                with self._gc_lock:
+                    self._gc_again = False
+                freed += self._collect()
+                with self._gc_lock:
+                    if not self._gc_again:
+                        return freed
+        finally:
+            with self._gc_lock:
+                self._gc_running = False
+
+    def _collect(self) -> int:
+        freed = 0
+        if not os.path.isdir(self.root):
+            return 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                blob = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(blob)
+                    if stat.st_nlink == 1:
+                        os.remove(blob)
+                        freed += stat.st_size
+                except FileNotFoundError:
+                    # removed by /rm since the walk listed it
+                    continue
+        return freed
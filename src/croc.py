@@ -0,0 +1,213 @@
+from collections import deque
+from dataclasses import dataclass
+import asyncio
+import re
+from src.utils import convert_to_mb, get_logger
+
+UNITS = r'(B|kB|KB|MB|GB|TB)'
+PROMPT_FILE_REGEX = re.compile(rf"Accept '(.+)' \(([\d.]+) {UNITS}\)\? \(Y/n\)")
+PROMPT_FOLDER_REGEX = re.compile(rf"Accept (\d+) files? and (\d+) folders? \(([\d.]+) {UNITS}\)\? \(Y/n\)")
+OFFER_REGEX = re.compile(r"Sending (?:'(.+)'|(\d+) files? and \d+ folders?) \((.+)\)")
+CODE_REGEX = re.compile(r"Code is: (\S+)")
+STARTED_REGEX = re.compile(r"^(Sending|Receiving) \((->|<-)(.*)\)")
+PROGRESS_REGEX = re.compile(rf"(\d+)%\s*\|.*\|\s*\(([\d.]+)\s*{UNITS}?/([\d.]+)\s*{UNITS},\s*([\d.]+)\s*{UNITS}/s\)")
+ERROR_REGEX = re.compile(r"^(?:\[error\]|error:?)\s*(.*)", re.IGNORECASE)
+MAX_PARTIAL_LINE = 4096
+
+@dataclass(slots=True)
+class PromptEvent:
+    name: str
+    size_mb: float
+    files: int = 1
+    folders: int = 0
+
+@dataclass(slots=True)
+class CodeEvent:
+    code: str
+    size: str | None
+
+@dataclass(slots=True)
+class SendingEvent:
+    direction: str
+    peer: str
+
+@dataclass(slots=True)
+class ProgressEvent:
+    name: str
+    percent: int
+    transferred_mb: float
+    total_mb: float
+    speed_mb: float
+
+@dataclass(slots=True)
+class DoneEvent:
+    returncode: int | None
+
+@dataclass(slots=True)
+class ErrorEvent:
+    message: str
+
+def _mb(value:str, unit:str) -> float:
+    return convert_to_mb(float(value), unit)
+
+class CrocStreamParser:
+    '''
+    Incremental parser for croc's terminal output. Bytes are split on both newlines and the
+    carriage returns croc uses to redraw progress bars, and each line is only looked at once,
+    so the cost per chunk doesn't grow with the amount of output seen so far.
+    '''
+    def __init__(self):
+        self.partial = b''
+        self.offer_size = None
+        self.prompted = False
+
+    def feed(self, chunk:bytes) -> list:
+        data = self.partial + chunk
+        lines = re.split(rb'[\r\n]', data)
+        self.partial = lines.pop()
+        events = []
+        for line in lines:
+            event = self.parse_line(line.decode(errors='replace').strip())
+            if event is not None:
+                events.append(event)
+        # the accept prompt waits for input without a trailing newline
+        if not self.prompted and self.partial.rstrip().endswith(b'(Y/n)'):
+            event = self.parse_line(self.partial.decode(errors='replace').strip())
+            if event is not None:
+                events.append(event)
+                self.partial = b''
+        if len(self.partial) > MAX_PARTIAL_LINE:
+            self.partial = self.partial[-MAX_PARTIAL_LINE:]
+        return events
+
+    def feed_eof(self) -> list:
+        line, self.partial = self.partial, b''
+        event = self.parse_line(line.decode(errors='replace').strip())
+        return [event] if event is not None else []
+
+    def parse_line(self, line:str):
+        if not line:
+            return None
+        if '%' in line and '|' in line:
+            match = PROGRESS_REGEX.search(line)
+            if match:
+                total_unit = match.group(5)
+                return ProgressEvent(
+                    name=line[:match.start()].strip(),
+                    percent=int(match.group(1)),
+                    transferred_mb=_mb(match.group(2), match.group(3) or total_unit),
+                    total_mb=_mb(match.group(4), total_unit),
+                    speed_mb=_mb(match.group(6), match.group(7)),
+                )
+            return None
+        if line.startswith('Accept'):
+            match = PROMPT_FILE_REGEX.search(line)
+            if match:
+                self.prompted = True
+                return PromptEvent(match.group(1), _mb(match.group(2), match.group(3)))
+            match = PROMPT_FOLDER_REGEX.search(line)
+            if match:
+                self.prompted = True
+                return PromptEvent('folder', _mb(match.group(3), match.group(4)), int(match.group(1)), int(match.group(2)))
+            return None
+        if line.startswith('Code is:'):
+            match = CODE_REGEX.search(line)
+            if match:
+                return CodeEvent(match.group(1), self.offer_size)
+            return None
+        if line.startswith('Sending') or line.startswith('Receiving'):
+            match = STARTED_REGEX.match(line)
+            if match:
+                return SendingEvent(match.group(1).lower(), match.group(3))
+            match = OFFER_REGEX.match(line)
+            if match:
+                self.offer_size = match.group(3)
+            return None
+        match = ERROR_REGEX.match(line)
+        if match:
+            return ErrorEvent(match.group(1) or line)
+        return None
+
+class CrocSession:
+    '''
+    A croc subprocess plus its parsed event stream. stderr is merged into stdout so a single
+    pipe carries everything croc prints and nothing is left unread.
+    '''
+    def __init__(self, args:list[str], stdin:bool = False):
+        self.args = args
+        self.stdin = stdin
+        self.process = None
+        self.parser = CrocStreamParser()
+        self.pending = deque()
+        self.listeners = []
+        self.finished = False
+        self.logger = get_logger()
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    @property
+    def returncode(self) -> int | None:
+        return self.process.returncode
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            *self.args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            stdin=asyncio.subprocess.PIPE if self.stdin else asyncio.subprocess.DEVNULL,
+        )
+        return self
+
+    async def next_event(self):
+        '''
+        The next parsed event, DoneEvent once croc has exited and None after that
+        '''
+        while not self.pending:
+            if self.finished:
+                return None
+            chunk = await self.process.stdout.read(4096)
+            if chunk:
+                events = self.parser.feed(chunk)
+            else:
+                events = self.parser.feed_eof()
+                await self.process.wait()
+                events.append(DoneEvent(self.process.returncode))
+                self.finished = True
+            for event in events:
+                self.emit(event)
+            self.pending.extend(events)
+        return self.pending.popleft()
+
+    def emit(self, event):
+        self.logger.debug(f'{"PROGRESS" if isinstance(event, ProgressEvent) else "CROC"} - {self.pid} - {event}', extra={'pid': self.pid})
+        for listener in self.listeners:
+            listener(event)
+
+    async def wait_for(self, *event_types, timeout:float | None = None):
+        '''
+        Skip ahead to the first event of one of event_types. Errors and DoneEvent are always
+        returned. Raises asyncio.TimeoutError if nothing relevant shows up within timeout.
+        '''
+        async def find():
+            while True:
+                event = await self.next_event()
+                if event is None or isinstance(event, (*event_types, ErrorEvent, DoneEvent)):
+                    return event
+        if timeout is None:
+            return await find()
+        return await asyncio.wait_for(find(), timeout)
+
+    async def answer(self, accept:bool):
+        self.process.stdin.write(b'y\n' if accept else b'n\n')
+        await self.process.stdin.drain()
+
+    def kill(self):
+        if self.process.returncode is None:
+            self.process.kill()
+
+    async def close(self):
+        if self.process.returncode is None:
+            self.process.terminate()
+        await self.process.wait()
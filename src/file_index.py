@@ -0,0 +1,499 @@
+from dataclasses import dataclass
+import asyncio
+import os
+import re
+import threading
+from src.fs_executor import get_fs_executor
+from src.search import PathSearch
+from src.utils import get_logger
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+FILES_ROOT = './files'
+GLOB_CHARS = re.compile(r'[*?]')
+GLOB_TOKENS = {'**/': '(?:.*/)?', '**': '.*', '*': '[^/]*', '?': '[^/]'}
+
+@dataclass(slots=True)
+class FileEntry:
+    path: str
+    name: str
+    is_dir: bool
+    size: int
+    mtime: float
+
+def relative_key(base_path:str, path:str) -> str:
+    '''
+    Turn an absolute path inside base_path into an index key ('' is the guild root, '/' separated)
+    '''
+    rel = os.path.relpath(path, base_path)
+    if rel == '.':
+        return ''
+    return rel.replace(os.sep, '/')
+
+def parent_key(key:str) -> str:
+    return key.rpartition('/')[0]
+
+def is_glob(pattern:str) -> bool:
+    return GLOB_CHARS.search(pattern) is not None
+
+def glob_regex(pattern:str) -> re.Pattern:
+    '''
+    * and ? match within one path component, ** matches across folders and **/ any number of
+    them, none included. Brackets are taken literally since they show up in file names far more
+    often than in patterns.
+    '''
+    parts = re.split(r'(\*\*/|\*\*|\*|\?)', pattern)
+    return re.compile(''.join(GLOB_TOKENS.get(part, re.escape(part)) for part in parts) + r'\Z', re.IGNORECASE)
+
+def drop_nested(entries:list[FileEntry]) -> list[FileEntry]:
+    '''
+    Remove duplicates and entries that sit inside another selected folder
+    '''
+    kept = []
+    for entry in sorted({entry.path: entry for entry in entries}.values(), key=lambda entry: entry.path.split('/')):
+        if kept and kept[-1].is_dir and entry.path.startswith(kept[-1].path + '/'):
+            continue
+        kept.append(entry)
+    return kept
+
+def read_tree(root:str, key:str, recursive:bool, known_dirs:set[str]) -> dict[str, tuple[float, list[FileEntry]] | None]:
+    '''
+    The disk half of a scan, safe to run in a worker thread. Maps every directory visited to its
+    mtime and entries (None if it has disappeared). Directories in known_dirs are only descended
+    into when recursive is set.
+    '''
+    listings = {}
+    stack = [key]
+    while stack:
+        current = stack.pop()
+        path = os.path.join(root, *current.split('/')) if current else root
+        try:
+            mtime = os.stat(path).st_mtime
+            with os.scandir(path) as it:
+                dir_entries = list(it)
+        except (FileNotFoundError, NotADirectoryError):
+            listings[current] = None
+            continue
+        entries = []
+        for dir_entry in dir_entries:
+            child = f'{current}/{dir_entry.name}' if current else dir_entry.name
+            try:
+                is_dir = dir_entry.is_dir(follow_symlinks=False)
+                stat = dir_entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            entries.append(FileEntry(child, dir_entry.name, is_dir, stat.st_size, stat.st_mtime))
+            if is_dir and (recursive or child not in known_dirs):
+                stack.append(child)
+        listings[current] = (mtime, entries)
+    return listings
+
+def read_path(root:str, key:str, known_dirs:set[str]):
+    '''
+    Stat a single path and, for directories, read everything below it
+    '''
+    path = os.path.join(root, *key.split('/')) if key else root
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None, {}
+    is_dir = os.path.isdir(path)
+    entry = FileEntry(key, key.rpartition('/')[2], is_dir, stat.st_size, stat.st_mtime) if key else None
+    return entry, read_tree(root, key, True, known_dirs) if is_dir else {}
+
+def changed_dirs(root:str, dir_mtimes:dict[str, float]) -> list[str]:
+    '''
+    Directories whose mtime moved since they were last scanned (one stat per directory)
+    '''
+    changed = []
+    for key, mtime in dir_mtimes.items():
+        try:
+            if os.stat(os.path.join(root, *key.split('/')) if key else root).st_mtime != mtime:
+                changed.append(key)
+        except FileNotFoundError:
+            changed.append(key)
+    return changed
+
+def list_guild_dirs(root:str) -> tuple[float, set[str]]:
+    os.makedirs(root, exist_ok=True)
+    with os.scandir(root) as it:
+        guilds = {entry.name for entry in it if entry.is_dir() and not entry.name.startswith('.')}
+    return os.stat(root).st_mtime, guilds
+
+class GuildIndex:
+    def __init__(self, guild:str, root:str):
+        self.guild = guild
+        self.root = root
+        self.entries: dict[str, FileEntry] = {}
+        self.children: dict[str, set[str]] = {}
+        self.dir_mtimes: dict[str, float] = {}
+        self.sizes: dict[str, int] = {}
+        self.search = PathSearch()
+        self.version = 0
+
+    @property
+    def used_bytes(self) -> int:
+        return self.sizes.get('', 0)
+
+    def full_path(self, key:str) -> str:
+        if not key:
+            return self.root
+        return os.path.join(self.root, *key.split('/'))
+
+    def get(self, key:str) -> FileEntry | None:
+        return self.entries.get(key)
+
+    def list_dir(self, key:str) -> list[FileEntry] | None:
+        if key not in self.children:
+            return None
+        return [self.entries[child] for child in self.children[key]]
+
+    def walk(self, key:str = ''):
+        '''
+        Yield every entry below key, depth first
+        '''
+        stack = [key]
+        while stack:
+            current = stack.pop()
+            for child in self.children.get(current, ()):
+                entry = self.entries[child]
+                yield entry
+                if entry.is_dir:
+                    stack.append(child)
+
+    def glob(self, pattern:str) -> list[FileEntry]:
+        '''
+        Entries whose whole path matches a shell style pattern, case insensitive. Only the
+        folder named by the pattern's literal prefix is walked.
+        '''
+        literal = GLOB_CHARS.split(pattern, 1)[0]
+        base = parent_key(literal)
+        if base and base not in self.children:
+            return []
+        regex = glob_regex(pattern)
+        return [entry for entry in self.walk(base) if regex.match(entry.path)]
+
+    def tree_size(self, key:str) -> int:
+        '''
+        Bytes of every file below key, kept up to date as entries change
+        '''
+        return self.sizes.get(key, 0)
+
+    def _put(self, entry:FileEntry):
+        old = self.entries.get(entry.path)
+        self.entries[entry.path] = entry
+        delta = (0 if entry.is_dir else entry.size) - (0 if old is None or old.is_dir else old.size)
+        if delta:
+            self._add_size(entry.path, delta)
+
+    def _pop(self, key:str):
+        old = self.entries.pop(key, None)
+        if old is not None and not old.is_dir and old.size:
+            self._add_size(key, -old.size)
+
+    def _add_size(self, key:str, delta:int):
+        while key:
+            key = parent_key(key)
+            self.sizes[key] = self.sizes.get(key, 0) + delta
+
+    def apply(self, listings:dict[str, tuple[float, list[FileEntry]] | None]):
+        '''
+        The in memory half of a scan, merges the output of read_tree. Listings of folders that
+        left the index while they were read are dropped so they can't come back as orphans.
+        '''
+        added = []
+        for current, listing in listings.items():
+            if listing is None:
+                self.remove(current)
+                continue
+            if current and current not in self.entries:
+                continue
+            mtime, entries = listing
+            self.dir_mtimes[current] = mtime
+            old = self.children.get(current, set())
+            new = set()
+            for entry in entries:
+                new.add(entry.path)
+                if entry.path not in self.entries:
+                    added.append(entry.path)
+                self._put(entry)
+            self.children[current] = new
+            for child in old - new:
+                self.remove(child)
+        if len(added) > 64:
+            self.search.add_many(added)
+        else:
+            for child in added:
+                self.search.add(child)
+        self.version += 1
+
+    def apply_path(self, key:str, entry:FileEntry | None, listings):
+        if key and entry is None:
+            self.remove(key)
+            return
+        if key:
+            self._put(entry)
+            self.search.add(key)
+            self.children.setdefault(parent_key(key), set()).add(key)
+        self.apply(listings)
+
+    def remove(self, key:str):
+        removed = list(self.walk(key))
+        for entry in removed:
+            self.search.remove(entry.path)
+            self._pop(entry.path)
+            self.children.pop(entry.path, None)
+            self.dir_mtimes.pop(entry.path, None)
+        for entry in removed:
+            if entry.is_dir:
+                self.sizes.pop(entry.path, None)
+        self.children.pop(key, None)
+        self.dir_mtimes.pop(key, None)
+        if key:
+            self.search.remove(key)
+            self._pop(key)
+            self.sizes.pop(key, None)
+            self.children.get(parent_key(key), set()).discard(key)
+        self.version += 1
+
+    def missing_parents(self, key:str) -> list[str]:
+        parent = parent_key(key)
+        missing = []
+        while parent and parent not in self.entries:
+            missing.append(parent)
+            parent = parent_key(parent)
+        return missing[::-1]
+
+def build_guild_index(guild:str, root:str, create:bool = True) -> GuildIndex:
+    '''
+    Read a guild folder and build its index, safe to run in a worker thread since nobody else
+    sees the index until it is published
+    '''
+    if create:
+        os.makedirs(root, exist_ok=True)
+    index = GuildIndex(guild, root)
+    index.apply(read_tree(root, '', True, set()))
+    return index
+
+class _WatchHandler(FileSystemEventHandler):
+    def __init__(self, index):
+        self.index = index
+
+    def on_any_event(self, event):
+        for path in (getattr(event, 'src_path', None), getattr(event, 'dest_path', None)):
+            if path:
+                self.index.mark_dirty(os.fsdecode(path))
+
+class FileIndex:
+    '''
+    Per-guild in memory metadata for ./files. Kept current by the bot's own upload/mv/rm paths
+    and by a watchdog observer (or directory mtime polling when watchdog is not installed).
+    All disk reads happen on the filesystem executor, the index itself is only touched on the loop
+    once published (full builds happen on the executor before that).
+    '''
+    def __init__(self, root:str = FILES_ROOT):
+        self.root = os.path.abspath(root)
+        self.guilds: dict[str, GuildIndex] = {}
+        self.fs = get_fs_executor()
+        self.logger = get_logger()
+        self._dirty: set[str] = set()
+        self._lock = threading.Lock()
+        self._observer = None
+        self._task = None
+        self._reconcile_task = None
+        self._root_mtime = None
+        self._building: dict[str, asyncio.Task] = {}
+
+    def guild(self, guild:str) -> GuildIndex:
+        if guild not in self.guilds:
+            self.guilds[guild] = GuildIndex(guild, os.path.join(self.root, guild))
+        return self.guilds[guild]
+
+    async def ensure_guild(self, guild:str) -> GuildIndex:
+        '''
+        Create the guild folder on first use and make sure its index has been built
+        '''
+        if guild in self.guilds:
+            return self.guilds[guild]
+        # a command and the background build asking for the same guild share one scan
+        if guild not in self._building:
+            self._building[guild] = asyncio.create_task(self._build_guild(guild))
+        return await asyncio.shield(self._building[guild])
+
+    async def _build_guild(self, guild:str) -> GuildIndex:
+        try:
+            # a large tree takes seconds to index, none of it on the loop
+            index = await self.fs.run('index_scan', build_guild_index, guild, os.path.join(self.root, guild))
+            if guild not in self.guilds:
+                self.guilds[guild] = index
+            return self.guilds[guild]
+        finally:
+            self._building.pop(guild, None)
+
+    async def build(self):
+        self._root_mtime, guilds = await self.fs.run('index_scan', list_guild_dirs, self.root)
+        await asyncio.gather(*(self.ensure_guild(guild) for guild in guilds))
+        self.logger.info(f'INDEX - built {len(guilds)} guild indexes with {sum(len(g.entries) for g in self.guilds.values())} entries')
+
+    def get(self, guild:str, key:str) -> FileEntry | None:
+        return self.guild(guild).get(key)
+
+    def exists(self, guild:str, key:str) -> bool:
+        return key == '' or self.guild(guild).get(key) is not None
+
+    def list_dir(self, guild:str, key:str) -> list[FileEntry] | None:
+        return self.guild(guild).list_dir(key)
+
+    def search(self, guild:str, query:str, limit:int = 10, within:str = '', fuzzy:bool = True) -> list[FileEntry]:
+        index = self.guild(guild)
+        return [index.entries[path] for path in index.search.search(query, limit, within, fuzzy)]
+
+    async def scan(self, guild:str, key:str = '', recursive:bool = True):
+        index = self.guild(guild)
+        listings = await self.fs.run('index_scan', read_tree, index.root, key, recursive, set(index.children))
+        index.apply(listings)
+
+    async def reconcile(self):
+        '''
+        Rebuild every guild's index from disk and swap it in, catching anything the watcher or
+        the bot's own bookkeeping missed
+        '''
+        for guild in list(self.guilds):
+            old = self.guilds[guild]
+            index = await self.fs.run('index_scan', build_guild_index, guild, old.root, False)
+            if self.guilds.get(guild) is not old:
+                # dropped or rebuilt while it was read
+                continue
+            # a fresh index can't inherit entries the old one lost track of
+            index.version = old.version + 1
+            self.guilds[guild] = index
+            before, after = old.used_bytes, index.used_bytes
+            if after != before or len(index.entries) != len(old.entries):
+                self.logger.info(f'INDEX - reconciled {guild} from {len(old.entries)} to {len(index.entries)} entries, usage from {before} to {after} bytes')
+
+    async def refresh(self, guild:str, key:str = ''):
+        '''
+        Bring a single path (and everything below it) back in line with the disk
+        '''
+        index = self.guild(guild)
+        missing = index.missing_parents(key)
+        if missing:
+            key = missing[0]
+        entry, listings = await self.fs.run('index_refresh', read_path, index.root, key, set(index.children))
+        index.apply_path(key, entry, listings)
+
+    def remove(self, guild:str, key:str):
+        self.guild(guild).remove(key)
+
+    async def move(self, guild:str, src:str, dst:str):
+        self.guild(guild).remove(src)
+        await self.refresh(guild, dst)
+        await self.scan(guild, parent_key(src), recursive=False)
+
+    def mark_dirty(self, path:str):
+        with self._lock:
+            self._dirty.add(path)
+
+    async def start(self, poll_interval:float = 30.0, reconcile_interval:float = 3600.0):
+        if self._task is not None:
+            return
+        if not self.guilds:
+            await self.build()
+        if Observer is not None:
+            try:
+                self._observer = Observer()
+                self._observer.schedule(_WatchHandler(self), self.root, recursive=True)
+                self._observer.daemon = True
+                self._observer.start()
+                self.logger.info('INDEX - watching files with watchdog')
+            except Exception as e:
+                self.logger.warning(f'INDEX - failed to start watchdog, falling back to polling: {e}')
+                self._observer = None
+        else:
+            self.logger.info(f'INDEX - watchdog not installed, polling every {poll_interval}s')
+        self._task = asyncio.create_task(self._sync_loop(1.0 if self._observer else poll_interval))
+        self._reconcile_task = asyncio.create_task(self._reconcile_loop(reconcile_interval))
+
+    def stop(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._reconcile_task is not None:
+            self._reconcile_task.cancel()
+            self._reconcile_task = None
+
+    async def sync(self):
+        '''
+        Apply pending watcher events, or poll directory mtimes when there is no watcher
+        '''
+        if self._observer is not None:
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+            targets = set()
+            for path in dirty:
+                key = relative_key(self.root, os.path.abspath(path))
+                if key == '' or key.startswith('..'):
+                    targets.add(('', ''))
+                    continue
+                guild, _, rest = key.partition('/')
+                if guild.startswith('.'):
+                    continue
+                targets.add((guild, parent_key(rest) if rest else ''))
+            for guild, key in targets:
+                # events under a folder that is no longer indexed (like a background /rm) are stale,
+                # a new folder is read whole by the scan of its parent
+                if key and guild in self.guilds and key not in self.guilds[guild].children:
+                    continue
+                await self._rescan(guild, key)
+            return
+        root_mtime = await self.fs.run('index_poll', lambda: os.stat(self.root).st_mtime)
+        if root_mtime != self._root_mtime:
+            await self._rescan('', '')
+        for guild, index in list(self.guilds.items()):
+            for key in await self.fs.run('index_poll', changed_dirs, index.root, dict(index.dir_mtimes)):
+                await self.scan(guild, key, recursive=False)
+
+    async def _rescan(self, guild:str, key:str):
+        if guild == '':
+            self._root_mtime, present = await self.fs.run('index_scan', list_guild_dirs, self.root)
+            for name in set(self.guilds) - present:
+                self.guilds.pop(name)
+            for name in present:
+                await self.ensure_guild(name)
+            return
+        if guild in self.guilds:
+            await self.scan(guild, key, recursive=False)
+        else:
+            await self.ensure_guild(guild)
+
+    async def _sync_loop(self, interval:float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                self.logger.error(f'INDEX - sync failed: {e}')
+
+    async def _reconcile_loop(self, interval:float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reconcile()
+            except Exception as e:
+                self.logger.error(f'INDEX - reconcile failed: {e}')
+
+_FILE_INDEX = None
+
+def get_file_index() -> FileIndex:
+    global _FILE_INDEX
+    if _FILE_INDEX is None:
+        _FILE_INDEX = FileIndex()
+    return _FILE_INDEX
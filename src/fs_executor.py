@@ -0,0 +1,91 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import asyncio
+import functools
+import itertools
+import time
+from src.metrics import get_metrics
+from src.utils import get_config, get_logger
+
+SLOW_OPERATION_S = 1.0
+# operations that read or delete whole files or trees, kept off the pool quick metadata calls use
+BULK_OPERATIONS = {'archive_build', 'archive_evict', 'dedup', 'rm', 'rmtree', 'gc'}
+
+class OperationStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def record(self, elapsed:float, failed:bool):
+        self.count += 1
+        self.errors += failed
+        self.total += elapsed
+        self.last = elapsed
+        self.max = max(self.max, elapsed)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+class FsExecutor:
+    '''
+    Bounded thread pools that every blocking filesystem call goes through so the event loop
+    (and the discord heartbeat) never waits on the disk. BULK_OPERATIONS, which can run for
+    minutes, get a pool of their own so they can't hold up quick calls like starting an upload,
+    index polls, quota checks or journal writes. Records latency per operation name.
+    '''
+    def __init__(self, max_workers:int = 4, bulk_workers:int = 2):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='float-fs')
+        self.bulk_pool = ThreadPoolExecutor(max_workers=bulk_workers, thread_name_prefix='float-fs-bulk')
+        self.stats: dict[str, OperationStats] = {}
+        self.jobs: dict[str, dict[int, dict]] = {}
+        self.logger = get_logger()
+        self.metrics = get_metrics()
+        self._job_ids = itertools.count()
+
+    async def run(self, operation:str, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        failed = False
+        try:
+            pool = self.bulk_pool if operation in BULK_OPERATIONS else self.pool
+            return await loop.run_in_executor(pool, functools.partial(fn, *args, **kwargs))
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stats.setdefault(operation, OperationStats()).record(elapsed, failed)
+            self.metrics.fs_seconds.observe(elapsed, operation=operation)
+            if failed:
+                self.metrics.fs_errors.inc(operation=operation)
+            if elapsed > SLOW_OPERATION_S:
+                self.logger.warning(f'FS - slow {operation} took {elapsed:.2f}s')
+
+    def start_job(self, guild:str, operation:str, file:str, owner:int, fn, *args) -> asyncio.Task:
+        '''
+        Run fn as a background job listed under the guild in /ps
+        '''
+        job_id = next(self._job_ids)
+        task = asyncio.create_task(self.run(operation, fn, *args))
+        self.jobs.setdefault(guild, {})[job_id] = {
+            'file': file,
+            'time': datetime.now(),
+            'owner': owner,
+            'operation': operation,
+            'task': task,
+        }
+        task.add_done_callback(lambda _: self.jobs[guild].pop(job_id, None))
+        return task
+
+_FS_EXECUTOR = None
+
+def get_fs_executor() -> FsExecutor:
+    global _FS_EXECUTOR
+    if _FS_EXECUTOR is None:
+        config = get_config()
+        _FS_EXECUTOR = FsExecutor(config.fs_workers, config.fs_bulk_workers)
+    return _FS_EXECUTOR
@@ -0,0 +1,196 @@
+import asyncio
+import json
+import os
+import shutil
+import signal
+import time
+import uuid
+from src.content_store import STAGING_ROOT, MergeConflict, merge_into
+from src.fs_executor import get_fs_executor
+from src.utils import get_config, get_logger
+
+COMPACT_RECORDS = 1000
+REAP_TIMEOUT_S = 5
+
+def read_journal(path:str) -> dict[str, dict]:
+    '''
+    Replay the journal into the entries that were begun and never ended
+    '''
+    entries = {}
+    try:
+        f = open(path)
+    except FileNotFoundError:
+        return entries
+    with f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # a write cut short by the crash
+                continue
+            event = record.pop('event')
+            if event == 'begin':
+                entries[record['id']] = record
+            elif event == 'update' and record['id'] in entries:
+                entries[record['id']].update(record)
+            elif event == 'end':
+                entries.pop(record['id'], None)
+    return entries
+
+def append_records(path:str, records:list[dict]):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(''.join(json.dumps(record) + '\n' for record in records))
+        f.flush()
+        os.fsync(f.fileno())
+
+def rewrite_journal(path:str, entries:list[dict]):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(temp, 'w') as f:
+        f.write(''.join(json.dumps({**entry, 'event': 'begin'}) + '\n' for entry in entries))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+
+def process_args(pid:int) -> list[str] | None:
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            return [arg.decode(errors='replace') for arg in f.read().split(b'\0') if arg]
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+
+def reap_process(pid:int, args:list[str]) -> bool:
+    '''
+    Stop pid if it is still the croc the journal started (same arguments, whatever interpreter
+    or wrapper it runs under). Returns whether anything was killed.
+    '''
+    running = process_args(pid)
+    if running is None or running[-(len(args) - 1):] != args[1:]:
+        return False
+    os.kill(pid, signal.SIGTERM)
+    deadline = time.monotonic() + REAP_TIMEOUT_S
+    while time.monotonic() < deadline:
+        # gone, or a zombie waiting for init to collect it
+        if not process_args(pid):
+            return True
+        time.sleep(0.1)
+    os.kill(pid, signal.SIGKILL)
+    return True
+
+def clean_staging(referenced:set[str]) -> int:
+    '''
+    Remove every staging directory the journal no longer knows about
+    '''
+    removed = 0
+    if not os.path.isdir(STAGING_ROOT):
+        return 0
+    for guild in os.listdir(STAGING_ROOT):
+        guild_dir = os.path.join(STAGING_ROOT, guild)
+        for name in os.listdir(guild_dir):
+            path = os.path.join(guild_dir, name)
+            if os.path.normpath(path) not in referenced:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+    return removed
+
+class TransferJournal:
+    '''
+    Append-only record of every croc process the bot starts (transfers, warm senders, the relay)
+    and of each upload's staging directory. Records are batched and fsynced off the event loop;
+    callers that need one on disk before going on await flush(). After a crash recover() replays
+    the journal, reaps the crocs left running and finishes or discards the staged uploads.
+    The file is rewritten with only the open entries on recovery and every COMPACT_RECORDS records.
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        self.entries: dict[str, dict] = {}
+        self.pending: list[dict] = []
+        self.written = 0
+        self.recovered = False
+        self.fs = get_fs_executor()
+        self.logger = get_logger()
+        self._flusher = None
+
+    def begin(self, kind:str, guild:str | None = None, **fields) -> str:
+        id = uuid.uuid4().hex
+        record = {'id': id, 'kind': kind, 'guild': guild, 'time': time.time(), **fields}
+        self.entries[id] = dict(record)
+        self._append({**record, 'event': 'begin'})
+        return id
+
+    def update(self, id:str, **fields):
+        if id in self.entries:
+            self.entries[id].update(fields)
+            self._append({'id': id, 'event': 'update', **fields})
+
+    def end(self, id:str, outcome:str | None = None):
+        if self.entries.pop(id, None) is not None:
+            self._append({'id': id, 'event': 'end', 'outcome': outcome})
+
+    def _append(self, record:dict):
+        self.pending.append(record)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while self.pending:
+            records, self.pending = self.pending, []
+            self.written += len(records)
+            try:
+                if self.written >= COMPACT_RECORDS:
+                    self.written = 0
+                    await self.fs.run('journal', rewrite_journal, self.path, [dict(entry) for entry in self.entries.values()])
+                else:
+                    await self.fs.run('journal', append_records, self.path, records)
+            except OSError as e:
+                self.logger.error(f'ERROR - JOURNAL - failed to write {len(records)} records to {self.path}: {e}')
+
+    async def flush(self):
+        if self._flusher is not None:
+            await asyncio.shield(self._flusher)
+
+    async def recover(self):
+        '''
+        Clean up after the previous run, only once per process and before any transfer starts
+        '''
+        if self.recovered:
+            return
+        self.recovered = True
+        entries = await self.fs.run('journal', read_journal, self.path)
+        await asyncio.gather(*(self._reap(entry) for entry in entries.values() if entry.get('pid') and entry.get('args')))
+        kept = []
+        for entry in entries.values():
+            if entry.get('staging') is None:
+                continue
+            path = os.path.normpath(entry['staging'])
+            if entry.get('received') and os.path.isdir(path):
+                # croc finished but the bot died before moving the upload into place
+                try:
+                    await self.fs.run('promote', merge_into, path, f"./files/{entry['guild']}")
+                    self.logger.warning(f"JOURNAL - resumed upload of {entry.get('file')} into {entry['guild']}")
+                except MergeConflict as e:
+                    self.logger.error(f"ERROR - JOURNAL - dropped upload of {entry.get('file')} into {entry['guild']}: {e}")
+                except OSError as e:
+                    self.logger.error(f"ERROR - JOURNAL - could not resume upload of {entry.get('file')} into {entry['guild']}, keeping it for the next start: {e}")
+                    kept.append(entry)
+        staging = {os.path.normpath(entry['staging']) for entry in kept}
+        removed = await self.fs.run('rmtree', clean_staging, staging)
+        await self.fs.run('journal', rewrite_journal, self.path, kept)
+        self.entries.update({entry['id']: entry for entry in kept})
+        self.logger.info(f'JOURNAL - recovered {len(entries)} unfinished entries, removed {removed} stale staging directories')
+
+    async def _reap(self, entry:dict):
+        try:
+            if await self.fs.run('reap', reap_process, entry['pid'], entry['args']):
+                self.logger.warning(f"JOURNAL - reaped orphaned {entry['kind']} croc {entry['pid']} from {entry.get('guild')}")
+        except OSError as e:
+            self.logger.error(f"ERROR - JOURNAL - could not reap croc {entry['pid']}: {e}")
+
+_JOURNAL = None
+
+def get_transfer_journal() -> TransferJournal:
+    global _JOURNAL
+    if _JOURNAL is None:
+        _JOURNAL = TransferJournal(get_config().journal_file)
+    return _JOURNAL
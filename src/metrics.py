@@ -0,0 +1,235 @@
+from collections import deque
+import asyncio
+import bisect
+import functools
+import time
+from aiohttp import web
+from src.utils import get_logger, set_log_context
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+SPEED_BUCKETS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+RECENT_SAMPLES = 1024
+LOOP_LAG_INTERVAL_S = 0.5
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names:tuple, values:tuple, extra:str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value:float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name:str, help:str, labels:tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def _key(self, labels:dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def clear(self):
+        self.values.clear()
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for key, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}')
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount:float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value:float, **labels):
+        self.values[self._key(labels)] = value
+
+class HistogramSeries:
+    def __init__(self, buckets:tuple):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def quantile(self, q:float) -> float:
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class Histogram(Metric):
+    '''
+    Prometheus style cumulative buckets, plus the last RECENT_SAMPLES observations per label
+    set for the p50/p99 shown in /stats
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name:str, help:str, labels:tuple = (), buckets:tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value:float, **labels):
+        key = self._key(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = HistogramSeries(self.buckets)
+        series.counts[bisect.bisect_left(self.buckets, value)] += 1
+        series.sum += value
+        series.count += 1
+        series.max = max(series.max, value)
+        series.recent.append(value)
+
+    def series(self, **labels) -> HistogramSeries | None:
+        return self.values.get(self._key(labels))
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for key, series in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), series.counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {_format_value(series.sum)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {series.count}')
+        return lines
+
+class Metrics:
+    '''
+    Every metric the bot records. Gauges that describe current state (queues, active transfers)
+    are filled in by collectors right before each scrape or /stats instead of being kept up to date.
+    '''
+    def __init__(self):
+        self.started = time.time()
+        self.metrics: list[Metric] = []
+        self.collectors = []
+        self.commands = self.add(Counter('float_commands_total', 'Slash commands handled', ('command', 'outcome')))
+        self.command_seconds = self.add(Histogram('float_command_seconds', 'Time from a slash command being invoked to its handler returning', ('command',)))
+        self.loop_lag = self.add(Histogram('float_event_loop_lag_seconds', 'How late the event loop woke up for a timer', buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)))
+        self.transfers = self.add(Counter('float_transfers_total', 'Finished croc transfers', ('operation', 'outcome')))
+        self.transfer_bytes = self.add(Counter('float_transfer_bytes_total', 'Bytes moved by croc transfers', ('operation',)))
+        self.transfer_seconds = self.add(Histogram('float_transfer_seconds', 'Duration of successful transfers', ('operation',)))
+        self.transfer_speed = self.add(Histogram('float_transfer_speed_mb', 'Average MB/s of successful transfers', ('operation',), SPEED_BUCKETS))
+        self.code_seconds = self.add(Histogram('float_download_code_seconds', 'Time from a /download getting a transfer slot to its croc code being shown'))
+        self.active_transfers = self.add(Gauge('float_active_transfers', 'Transfers holding a slot', ('guild',)))
+        self.queued_transfers = self.add(Gauge('float_queued_transfers', 'Transfers waiting for a slot', ('guild',)))
+        self.transfer_rate = self.add(Gauge('float_transfer_rate_mb', 'Current MB/s summed over running transfers', ('guild',)))
+        self.fs_seconds = self.add(Histogram('float_fs_operation_seconds', 'Blocking filesystem operations run in the executor', ('operation',)))
+        self.fs_errors = self.add(Counter('float_fs_operation_errors_total', 'Filesystem operations that raised', ('operation',)))
+
+    def add(self, metric:Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self):
+        for collector in list(self.collectors):
+            try:
+                collector(self)
+            except Exception as e:
+                get_logger().error(f'METRICS - collector {collector} failed: {e}')
+
+    def render(self) -> str:
+        self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+def timed_command(name:str):
+    '''
+    Record latency and outcome of a slash command handler, and tag its log lines with the
+    command, guild and user
+    '''
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(cog, interaction, *args, **kwargs):
+            guild = interaction.guild.name if interaction.guild is not None else None
+            set_log_context(command=name, guild=guild, user=interaction.user.id)
+            metrics = get_metrics()
+            start = time.perf_counter()
+            outcome = 'error'
+            try:
+                result = await fn(cog, interaction, *args, **kwargs)
+                outcome = 'ok'
+                return result
+            finally:
+                metrics.command_seconds.observe(time.perf_counter() - start, command=name)
+                metrics.commands.inc(command=name, outcome=outcome)
+        return wrapper
+    return decorator
+
+class LoopLagMonitor:
+    def __init__(self, metrics:Metrics, interval:float = LOOP_LAG_INTERVAL_S):
+        self.metrics = metrics
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.metrics.loop_lag.observe(max(0.0, loop.time() - start - self.interval))
+
+class MetricsServer:
+    '''
+    Serves the metrics in the Prometheus text format on http://host:port/metrics
+    '''
+    def __init__(self, metrics:Metrics, host:str, port:int):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.runner = None
+        self.logger = get_logger()
+
+    async def handle(self, request):
+        return web.Response(body=self.metrics.render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        self.logger.info(f'METRICS - serving metrics on http://{self.host}:{self.port}/metrics')
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+_METRICS = None
+
+def get_metrics() -> Metrics:
+    global _METRICS
+    if _METRICS is None:
+        _METRICS = Metrics()
+    return _METRICS
@@ -0,0 +1,106 @@
+import discord
+from src.utils import get_logger
+
+PAGE_CHARS = 1800
+PAGE_VIEW_TIMEOUT_S = 300
+
+class Pager:
+    '''
+    Splits a lazy iterator of lines into pages of at most page_lines lines and max_chars
+    characters. Lines are only pulled when a page is asked for, one line ahead so the last
+    page is known as soon as it is built.
+    '''
+    def __init__(self, lines, page_lines:int, max_chars:int = PAGE_CHARS):
+        self.lines = iter(lines)
+        self.page_lines = page_lines
+        self.max_chars = max_chars
+        self.pages: list[list[str]] = []
+        self.pending = None
+        self.done = False
+        self._pull()
+
+    def _pull(self):
+        try:
+            line = next(self.lines)
+        except StopIteration:
+            self.pending = None
+            self.done = True
+            return
+        self.pending = line if len(line) <= self.max_chars else line[:self.max_chars - 3] + '...'
+
+    def _build(self):
+        page = []
+        chars = 0
+        while self.pending is not None and len(page) < self.page_lines and chars + len(self.pending) + 1 <= self.max_chars:
+            page.append(self.pending)
+            chars += len(self.pending) + 1
+            self._pull()
+        self.pages.append(page)
+
+    def page(self, number:int) -> list[str]:
+        while len(self.pages) <= number and not (self.done and self.pages):
+            self._build()
+        return self.pages[min(number, len(self.pages) - 1)]
+
+    def is_last(self, number:int) -> bool:
+        self.page(number)
+        return self.done and number >= len(self.pages) - 1
+
+    @property
+    def total(self) -> int | None:
+        return len(self.pages) if self.done else None
+
+class PagerView(discord.ui.View):
+    '''
+    Previous/next buttons over a Pager, only usable by the member who ran the command
+    '''
+    def __init__(self, pager:Pager, header:str, owner:int, code_block:bool = False):
+        super().__init__(timeout=PAGE_VIEW_TIMEOUT_S)
+        self.pager = pager
+        self.header = header
+        self.owner = owner
+        self.code_block = code_block
+        self.number = 0
+        self.message = None
+        self.logger = get_logger()
+        self.update_buttons()
+
+    def render(self) -> str:
+        body = '\n'.join(self.pager.page(self.number))
+        if self.code_block:
+            body = f'```\n{body}\n```'
+        total = self.pager.total
+        footer = f'Page {self.number + 1}/{total}' if total is not None else f'Page {self.number + 1}'
+        return f'{self.header}\n{body}\n{footer}'
+
+    def update_buttons(self):
+        self.previous.disabled = self.number == 0
+        self.next.disabled = self.pager.is_last(self.number)
+
+    @property
+    def single_page(self) -> bool:
+        return self.pager.is_last(0)
+
+    async def interaction_check(self, interaction:discord.Interaction) -> bool:
+        return interaction.user.id == self.owner
+
+    @discord.ui.button(label='Previous', style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction:discord.Interaction, button:discord.ui.Button):
+        self.number = max(0, self.number - 1)
+        self.update_buttons()
+        await interaction.response.edit_message(content=self.render(), view=self)
+
+    @discord.ui.button(label='Next', style=discord.ButtonStyle.secondary)
+    async def next(self, interaction:discord.Interaction, button:discord.ui.Button):
+        if not self.pager.is_last(self.number):
+            self.number += 1
+        self.update_buttons()
+        await interaction.response.edit_message(content=self.render(), view=self)
+
+    async def on_timeout(self):
+        if self.message is None:
+            return
+        try:
+            await self.message.edit(view=None)
+        except discord.HTTPException as e:
+            self.logger.debug(f'PAGER - failed to remove buttons from expired listing: {e}')
@@ -0,0 +1,100 @@
+import asyncio
+import time
+import discord
+from src.croc import ProgressEvent, PromptEvent, SendingEvent
+from src.utils import format_duration, get_logger
+
+class TransferStats:
+    '''
+    Bytes moved, throughput and ETA for one transfer, fed from croc's progress bars
+    '''
+    def __init__(self, total_mb:float | None = None):
+        self.total_mb = total_mb
+        self.files: dict[str, tuple[float, float]] = {}
+        self.speed_mb = 0.0
+        self.started = None
+
+    def on_event(self, event):
+        if isinstance(event, PromptEvent):
+            self.total_mb = event.size_mb
+        elif isinstance(event, SendingEvent):
+            self.started = time.monotonic()
+        elif isinstance(event, ProgressEvent):
+            if self.started is None:
+                self.started = time.monotonic()
+            self.files[event.name] = (event.transferred_mb, event.total_mb)
+            self.speed_mb = event.speed_mb
+
+    @property
+    def transferred_mb(self) -> float:
+        return sum(transferred for transferred, _ in self.files.values())
+
+    @property
+    def expected_mb(self) -> float | None:
+        seen = sum(total for _, total in self.files.values())
+        if self.total_mb is None:
+            return seen or None
+        return max(self.total_mb, seen)
+
+    @property
+    def average_mb(self) -> float:
+        if self.started is None:
+            return 0.0
+        elapsed = time.monotonic() - self.started
+        return self.transferred_mb / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta_s(self) -> float | None:
+        expected = self.expected_mb
+        speed = self.speed_mb or self.average_mb
+        if expected is None or not speed:
+            return None
+        return max(0.0, expected - self.transferred_mb) / speed
+
+    def describe(self) -> str:
+        if self.started is None:
+            return "waiting to start"
+        expected = self.expected_mb
+        progress = f"{self.transferred_mb:.1f}/{expected:.1f} MB" if expected else f"{self.transferred_mb:.1f} MB"
+        if expected:
+            progress += f" ({min(100.0, self.transferred_mb / expected * 100):.0f}%)"
+        eta = self.eta_s
+        return f"{progress} at {self.speed_mb:.2f} MB/s (avg {self.average_mb:.2f} MB/s), ETA {format_duration(eta) if eta is not None else 'unknown'}"
+
+class MessageUpdater:
+    '''
+    Coalesces edits to one message so it is edited at most once every interval seconds,
+    always with the most recent content
+    '''
+    def __init__(self, msg, interval:float):
+        self.msg = msg
+        self.interval = interval
+        self.content = None
+        self.last_edit = 0.0
+        self.task = None
+        self.logger = get_logger()
+
+    def update(self, content:str):
+        self.content = content
+        if self.task is None:
+            delay = max(0.0, self.last_edit + self.interval - time.monotonic())
+            self.task = asyncio.create_task(self._flush(delay))
+
+    async def _flush(self, delay:float):
+        await asyncio.sleep(delay)
+        self.task = None
+        await self._edit(self.content)
+
+    async def _edit(self, content:str):
+        self.last_edit = time.monotonic()
+        try:
+            await self.msg.edit(content=content)
+        except discord.HTTPException as e:
+            self.logger.debug(f'PROGRESS - failed to edit progress message: {e}')
+
+    async def close(self, content:str | None = None):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if content is not None:
+            await self._edit(content)
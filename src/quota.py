@@ -0,0 +1,74 @@
+from dataclasses import dataclass
+import shutil
+from src.file_index import FILES_ROOT, get_file_index
+from src.fs_executor import get_fs_executor
+from src.utils import get_config, get_logger
+
+MB = 1024 * 1024
+
+class QuotaExceeded(Exception):
+    pass
+
+@dataclass(eq=False)
+class Reservation:
+    guild: str
+    size: int
+
+class QuotaManager:
+    '''
+    Admission control for uploads. A guild's usage comes straight from its index (kept up to
+    date incrementally), in-flight uploads hold a reservation for the size croc announced until
+    they land, and the volume must keep reserve_mb free on top of every reservation.
+    A quota of 0 means unlimited.
+    '''
+    def __init__(self, default_quota_mb:float, guild_quotas_mb:dict[str, float], reserve_mb:float, root:str = FILES_ROOT):
+        self.default_quota_mb = default_quota_mb
+        self.guild_quotas_mb = guild_quotas_mb
+        self.reserve_bytes = int(reserve_mb * MB)
+        self.root = root
+        self.index = get_file_index()
+        self.fs = get_fs_executor()
+        self.logger = get_logger()
+        self.reservations: set[Reservation] = set()
+
+    def quota_bytes(self, guild:str) -> int | None:
+        quota_mb = self.guild_quotas_mb.get(guild, self.default_quota_mb)
+        return int(quota_mb * MB) if quota_mb else None
+
+    def used_bytes(self, guild:str) -> int:
+        return self.index.guild(guild).used_bytes
+
+    def reserved_bytes(self, guild:str | None = None) -> int:
+        return sum(reservation.size for reservation in self.reservations if guild is None or reservation.guild == guild)
+
+    async def free_bytes(self) -> int:
+        return (await self.fs.run('disk_usage', shutil.disk_usage, self.root)).free
+
+    async def reserve(self, guild:str, size:int) -> Reservation:
+        '''
+        Hold size bytes for an upload, raises QuotaExceeded with a message for the user if it doesn't fit
+        '''
+        free = await self.free_bytes()
+        quota = self.quota_bytes(guild)
+        if quota is not None:
+            committed = self.used_bytes(guild) + self.reserved_bytes(guild)
+            if committed + size > quota:
+                raise QuotaExceeded(f"This server is using {committed / MB:.1f} MB of its {quota / MB:.0f} MB quota, {size / MB:.1f} MB more would not fit. Free up space with /rm (see /du).")
+        if free - self.reserved_bytes() - size < self.reserve_bytes:
+            self.logger.warning(f'QUOTA - {guild} - refusing {size} bytes, {free} free with {self.reserved_bytes()} reserved')
+            raise QuotaExceeded("The bot is running out of disk space, try again later.")
+        reservation = Reservation(guild, size)
+        self.reservations.add(reservation)
+        return reservation
+
+    def release(self, reservation:Reservation):
+        self.reservations.discard(reservation)
+
+_QUOTA_MANAGER = None
+
+def get_quota_manager() -> QuotaManager:
+    global _QUOTA_MANAGER
+    if _QUOTA_MANAGER is None:
+        config = get_config()
+        _QUOTA_MANAGER = QuotaManager(config.guild_quota_mb, config.guild_quotas_mb, config.min_free_space_mb)
+    return _QUOTA_MANAGER
@@ -0,0 +1,117 @@
+import asyncio
+from src.journal import get_transfer_journal
+from src.utils import get_logger
+
+HEALTH_CHECK_TIMEOUT_S = 3
+MAX_BACKOFF_S = 60
+
+class RelaySupervisor:
+    '''
+    Runs the bot's own `croc relay`, checks it accepts connections on its first port every
+    interval seconds and restarts it (with backoff) when it dies or stops answering.
+    '''
+    def __init__(self, croc_path:str, host:str, ports:list[int], password:str, public_address:str, interval:float):
+        self.croc_path = croc_path
+        self.host = host
+        self.ports = ports
+        self.password = password
+        self.public_address = public_address or f'{host}:{ports[0]}'
+        self.interval = interval
+        self.process = None
+        self.healthy = False
+        self.restarts = 0
+        self.journal = get_transfer_journal()
+        self.journal_id = None
+        self.logger = get_logger()
+        self._task = None
+
+    @property
+    def address(self) -> str:
+        return f'{self.host}:{self.ports[0]}'
+
+    def client_args(self) -> list[str]:
+        '''
+        Global croc flags that point a send/receive at this relay, empty while it is down
+        '''
+        if not self.healthy:
+            return []
+        return ['--relay', self.address, '--pass', self.password]
+
+    def receive_hint(self, code:str) -> str:
+        return f'croc --relay {self.public_address} --pass {self.password} {code}'
+
+    def send_hint(self) -> str:
+        return f'croc --relay {self.public_address} --pass {self.password} send <file>'
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._supervise())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self._kill()
+
+    async def _spawn(self):
+        args = [self.croc_path, '--pass', self.password, 'relay', '--ports', ','.join(str(port) for port in self.ports)]
+        self.logger.info(f'RELAY - starting croc relay on ports {self.ports}')
+        self.process = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            stdin=asyncio.subprocess.DEVNULL,
+        )
+        if self.journal_id is not None:
+            self.journal.end(self.journal_id, 'restarted')
+        self.journal_id = self.journal.begin('relay', pid=self.process.pid, args=args)
+        asyncio.create_task(self._drain(self.process))
+
+    async def _drain(self, process):
+        while line := await process.stdout.readline():
+            self.logger.debug(f'RELAY - {process.pid} - {line.decode(errors="replace").rstrip()}', extra={'pid': process.pid})
+
+    async def _kill(self):
+        self.healthy = False
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+            try:
+                await asyncio.wait_for(self.process.wait(), HEALTH_CHECK_TIMEOUT_S)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+        if self.journal_id is not None:
+            self.journal.end(self.journal_id, 'stopped')
+            self.journal_id = None
+
+    async def check(self) -> bool:
+        if self.process is None or self.process.returncode is not None:
+            return False
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.ports[0]), HEALTH_CHECK_TIMEOUT_S)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        await writer.wait_closed()
+        return True
+
+    async def _supervise(self):
+        backoff = 1
+        while True:
+            if self.process is None or self.process.returncode is not None:
+                await self._spawn()
+                await asyncio.sleep(1)
+            healthy = await self.check()
+            if healthy != self.healthy:
+                self.logger.info(f'RELAY - relay at {self.address} is {"healthy" if healthy else "unhealthy"}')
+            self.healthy = healthy
+            if healthy:
+                backoff = 1
+                await asyncio.sleep(self.interval)
+                continue
+            self.restarts += 1
+            self.logger.warning(f'RELAY - restarting relay (restart {self.restarts}) in {backoff}s')
+            await self._kill()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF_S)
+            self.process = None
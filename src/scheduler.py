@@ -0,0 +1,134 @@
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+import asyncio
+import itertools
+import time
+from src.utils import get_logger
+
+@dataclass(eq=False)
+class Ticket:
+    guild: str
+    user: int
+    size_mb: float | None
+    seq: int
+    on_position: object = None
+    enqueued: float = field(default_factory=time.monotonic)
+    future: asyncio.Future = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+    position: int = 0
+    notifier: asyncio.Task | None = None
+
+class TransferScheduler:
+    '''
+    Admits transfers under a per-guild and a global concurrency limit. Waiting transfers are
+    served small files (or ones that have waited longer than aging_s) first, then whichever
+    guild and user currently have the fewest transfers running, then first come first served.
+    '''
+    def __init__(self, per_guild_limit:int, global_limit:int, small_file_mb:float, aging_s:float):
+        self.per_guild_limit = per_guild_limit
+        self.global_limit = global_limit
+        self.small_file_mb = small_file_mb
+        self.aging_s = aging_s
+        self.active: dict[str, int] = {}
+        self.active_users: dict[tuple[str, int], int] = {}
+        self.waiting: list[Ticket] = []
+        self.logger = get_logger()
+        self._seq = itertools.count()
+
+    @property
+    def total_active(self) -> int:
+        return sum(self.active.values())
+
+    def queued(self, guild:str) -> int:
+        return sum(1 for ticket in self.waiting if ticket.guild == guild)
+
+    def _priority(self, ticket:Ticket, now:float):
+        small = ticket.size_mb is not None and ticket.size_mb <= self.small_file_mb
+        aged = now - ticket.enqueued > self.aging_s
+        return (
+            not (small or aged),
+            self.active.get(ticket.guild, 0),
+            self.active_users.get((ticket.guild, ticket.user), 0),
+            ticket.seq,
+        )
+
+    def _has_capacity(self, guild:str) -> bool:
+        return self.total_active < self.global_limit and self.active.get(guild, 0) < self.per_guild_limit
+
+    def _grant(self, ticket:Ticket):
+        self.active[ticket.guild] = self.active.get(ticket.guild, 0) + 1
+        key = (ticket.guild, ticket.user)
+        self.active_users[key] = self.active_users.get(key, 0) + 1
+        if not ticket.future.done():
+            ticket.future.set_result(None)
+
+    def _release(self, ticket:Ticket):
+        self.active[ticket.guild] -= 1
+        key = (ticket.guild, ticket.user)
+        self.active_users[key] -= 1
+        if not self.active_users[key]:
+            del self.active_users[key]
+        self._dispatch()
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.waiting:
+            ready = [ticket for ticket in self.waiting if self._has_capacity(ticket.guild)]
+            if not ready:
+                break
+            ticket = min(ready, key=lambda t: self._priority(t, now))
+            self.waiting.remove(ticket)
+            self._grant(ticket)
+        self._publish_positions(now)
+
+    def _publish_positions(self, now:float):
+        ordered = sorted(self.waiting, key=lambda t: self._priority(t, now))
+        for position, ticket in enumerate(ordered, 1):
+            if ticket.position != position:
+                ticket.position = position
+                if ticket.on_position is not None and ticket.notifier is None:
+                    ticket.notifier = asyncio.create_task(self._notify(ticket))
+
+    async def _notify(self, ticket:Ticket):
+        '''
+        Hand the latest position to on_position one call at a time, positions that change while a
+        call is running are coalesced into the next one
+        '''
+        published = 0
+        try:
+            while ticket.position != published and not ticket.future.done():
+                published = ticket.position
+                await ticket.on_position(published)
+        except Exception as e:
+            self.logger.warning(f'QUEUE - failed to publish the queue position of {ticket.user} in {ticket.guild}: {e}')
+        finally:
+            ticket.notifier = None
+
+    @asynccontextmanager
+    async def slot(self, guild:str, user:int, size_mb:float | None = None, on_position=None):
+        '''
+        Wait for a transfer slot. on_position is awaited with the queue position whenever it changes,
+        never more than one call at a time.
+        '''
+        ticket = Ticket(guild, user, size_mb, next(self._seq), on_position)
+        self.waiting.append(ticket)
+        self._dispatch()
+        if not ticket.future.done():
+            self.logger.info(f'QUEUE - {user} queued in {guild} at position {ticket.position}, active:{self.active.get(guild, 0)}, global:{self.total_active}')
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.notifier is not None:
+                ticket.notifier.cancel()
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+                self._publish_positions(time.monotonic())
+            else:
+                self._release(ticket)
+            raise
+        try:
+            if ticket.notifier is not None:
+                # let an edit in flight land before the transfer starts writing to the same message
+                await ticket.notifier
+            yield ticket
+        finally:
+            self._release(ticket)
@@ -0,0 +1,213 @@
+from bisect import bisect_left, insort
+from collections import Counter
+import heapq
+
+EXACT = 0
+PREFIX = 1
+SUBSTRING = 2
+FUZZY = 3
+# most candidates (names sharing enough n-grams) and edit distance checks one fuzzy pass may do
+FUZZY_MAX_CANDIDATES = 200
+FUZZY_MAX_CHECKS = 25
+# most names one fuzzy pass looks at while collecting candidates
+FUZZY_MAX_SCANNED = 5000
+
+def grams(text:str, n:int) -> set[str]:
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+def trigrams(text:str) -> set[str]:
+    return grams(text, 3)
+
+def stem(name:str) -> str:
+    base, dot, _ = name.rpartition('.')
+    return base if dot and base else name
+
+def edit_distance(query:str, text:str, max_distance:int) -> int:
+    '''
+    Levenshtein distance between query and text. Only the cells within max_distance of the
+    diagonal are computed, gives up early and returns max_distance + 1 once that can't be reached.
+    '''
+    if abs(len(query) - len(text)) > max_distance:
+        return max_distance + 1
+    if query == text:
+        return 0
+    over = max_distance + 1
+    previous = [j if j <= max_distance else over for j in range(len(text) + 1)]
+    for i, char_q in enumerate(query, 1):
+        low, high = max(1, i - max_distance), min(len(text), i + max_distance)
+        current = [over] * (len(text) + 1)
+        current[0] = i if i <= max_distance else over
+        for j in range(low, high + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_q != text[j - 1]), over)
+        if min(current[low - 1:high + 1]) > max_distance:
+            return over
+        previous = current
+    return previous[-1]
+
+class PathSearch:
+    '''
+    Trigram + prefix index over every path in a guild, plus bigrams for fuzzy matching short
+    terms. Results are ranked exact > prefix > substring > edit distance, ties broken by depth,
+    length then path.
+    '''
+    def __init__(self):
+        self.names: dict[str, str] = {}
+        self.lowered: dict[str, str] = {}
+        self.trigrams: dict[str, set[str]] = {}
+        self.bigrams: dict[str, set[str]] = {}
+        self.lengths: dict[int, set[str]] = {}
+        self.sorted_names: list[tuple[str, str]] = []
+        self._sorted_dirty = False
+
+    def add(self, path:str):
+        if path in self.names:
+            return
+        lower = path.lower()
+        name = lower.rpartition('/')[2]
+        self.names[path] = name
+        self.lowered[path] = lower
+        for trigram in trigrams(name):
+            self.trigrams.setdefault(trigram, set()).add(path)
+        for bigram in grams(name, 2):
+            self.bigrams.setdefault(bigram, set()).add(path)
+        for length in {len(name), len(stem(name))}:
+            self.lengths.setdefault(length, set()).add(path)
+        if not self._sorted_dirty:
+            insort(self.sorted_names, (name, path))
+
+    def add_many(self, paths):
+        self._sorted_dirty = True
+        for path in paths:
+            self.add(path)
+
+    def remove(self, path:str):
+        name = self.names.pop(path, None)
+        if name is None:
+            return
+        del self.lowered[path]
+        for n, index in ((3, self.trigrams), (2, self.bigrams)):
+            for gram in grams(name, n):
+                postings = index.get(gram)
+                if postings is not None:
+                    postings.discard(path)
+                    if not postings:
+                        del index[gram]
+        for length in {len(name), len(stem(name))}:
+            paths = self.lengths.get(length)
+            if paths is not None:
+                paths.discard(path)
+                if not paths:
+                    del self.lengths[length]
+        if not self._sorted_dirty:
+            i = bisect_left(self.sorted_names, (name, path))
+            if i < len(self.sorted_names) and self.sorted_names[i] == (name, path):
+                del self.sorted_names[i]
+
+    def search(self, query:str, limit:int = 10, within:str = '', fuzzy:bool = True) -> list[str]:
+        query = query.lower().strip('/')
+        if not query or limit <= 0:
+            return []
+        if self._sorted_dirty:
+            self.sorted_names = sorted((name, path) for path, name in self.names.items())
+            self._sorted_dirty = False
+        scope = f'{within}/' if within else ''
+        scope_depth = scope.count('/')
+        full_query = scope.lower() + query
+        term = query.rpartition('/')[2] or query
+        ranked = {}
+
+        def rank_of(path, lower):
+            if lower == full_query or self.names[path] == query:
+                return EXACT
+            if self.names[path].startswith(query) or lower.startswith(full_query):
+                return PREFIX
+            return SUBSTRING
+
+        # names starting with the term come straight out of the sorted list
+        i = bisect_left(self.sorted_names, (term, ''))
+        while i < len(self.sorted_names) and self.sorted_names[i][0].startswith(term):
+            path = self.sorted_names[i][1]
+            lower = self.lowered[path]
+            if query in lower and path.startswith(scope):
+                ranked[path] = (rank_of(path, lower), 0, path.count('/'), len(path), path)
+            i += 1
+
+        # a path prefix match is at least one level deeper than the scope, so once there are
+        # enough shallow prefix hits nothing the substring pass finds can outrank them
+        shallow = sum(1 for key in ranked.values() if key[0] <= PREFIX and key[2] <= scope_depth)
+        if shallow < limit:
+            if len(term) >= 3:
+                postings = sorted((self.trigrams.get(t, set()) for t in trigrams(term)), key=len)
+                candidates = set.intersection(*postings) if postings[0] else set()
+            else:
+                candidates = self.names.keys()
+            for path in candidates:
+                lower = self.lowered[path]
+                if query in lower and path not in ranked and path.startswith(scope):
+                    ranked[path] = (rank_of(path, lower), 0, path.count('/'), len(path), path)
+
+        # a typo can't be told apart from a name that exists, so an exact hit ends the search
+        if fuzzy and len(ranked) < limit and not any(key[0] == EXACT for key in ranked.values()):
+            # only the name is matched loosely, a folder in the query has to match exactly
+            folder = full_query.rpartition('/')[0] if '/' in full_query else None
+            for path, distance in self._fuzzy(term, folder):
+                if path not in ranked:
+                    ranked[path] = (FUZZY, distance, path.count('/'), len(path), path)
+
+        return [key[-1] for key in heapq.nsmallest(limit, ranked.values())]
+
+    def _fuzzy(self, term:str, folder:str | None):
+        '''
+        Names (with or without their extension) within a small edit distance of term, in folder
+        when given. k edits destroy at most n*k of the term's distinct n-grams, so a match shares
+        at least needed = grams - n*k of them and contains one of the (grams - needed + 1) rarest
+        (counting repeated n-grams once per position).
+        Trigrams are used when that bound is tight enough, bigrams for short terms. Candidates are
+        also cut to names of about the term's length and collected rarest n-gram first, stopping
+        once there are FUZZY_MAX_CANDIDATES or FUZZY_MAX_SCANNED names were looked at. Only the
+        FUZZY_MAX_CHECKS sharing the most n-grams get the edit distance computed.
+        '''
+        max_distance = 1 if len(term) <= 6 else 2
+        for n, index in ((3, self.trigrams), (2, self.bigrams)):
+            positions = [term[i:i + n] for i in range(len(term) - n + 1)]
+            needed = len(positions) - n * max_distance
+            if needed >= 2:
+                break
+        if needed <= 0:
+            return
+        term_grams = Counter(positions)
+        rarest = sorted(set(sorted(positions, key=lambda gram: len(index.get(gram, ())))[:len(positions) - needed + 1]), key=lambda gram: len(index.get(gram, ())))
+        lengths = [self.lengths.get(length, set()) for length in range(len(term) - max_distance, len(term) + max_distance + 1)]
+        candidates = set()
+        scanned = 0
+        for gram in rarest:
+            postings = index.get(gram, set())
+            for paths in lengths:
+                found = postings & paths
+                scanned += len(found)
+                if folder is not None:
+                    found = {path for path in found if self.lowered[path].rpartition('/')[0] == folder}
+                candidates |= found
+                if scanned >= FUZZY_MAX_SCANNED:
+                    break
+            # names holding the rarest parts of the term are checked first, the rest is dropped
+            if len(candidates) >= FUZZY_MAX_CANDIDATES or scanned >= FUZZY_MAX_SCANNED:
+                break
+        distinct = set(positions)
+        scored = []
+        for path in candidates:
+            name = self.names[path]
+            name_grams = [name[i:i + n] for i in range(len(name) - n + 1)]
+            # the distinct n-gram bound is cheaper and weaker, only names passing it are counted exactly
+            if len(distinct.intersection(name_grams)) < len(distinct) - n * max_distance:
+                continue
+            shared = sum((term_grams & Counter(name_grams)).values())
+            if shared >= needed:
+                scored.append((-shared, len(name), path))
+        for _, _, path in heapq.nsmallest(FUZZY_MAX_CHECKS, scored):
+            name = self.names[path]
+            distance = edit_distance(term, name, max_distance)
+            if distance and stem(name) != name:
+                distance = min(distance, edit_distance(term, stem(name), max_distance))
+            if distance <= max_distance:
+                yield path, distance
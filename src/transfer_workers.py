@@ -0,0 +1,342 @@
+from dataclasses import asdict
+import asyncio
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from src.croc import CodeEvent, CrocSession, DoneEvent, ErrorEvent, ProgressEvent, PromptEvent, SendingEvent
+from src.utils import get_config, get_logger
+
+EVENT_TYPES = {cls.__name__: cls for cls in (PromptEvent, CodeEvent, SendingEvent, ProgressEvent, DoneEvent, ErrorEvent)}
+PROGRESS_FORWARD_INTERVAL_S = 0.25
+IPC_LINE_LIMIT = 1024 * 1024
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def encode_event(event) -> dict:
+    return {'type': type(event).__name__, **asdict(event)}
+
+def decode_event(data:dict):
+    data = dict(data)
+    return EVENT_TYPES[data.pop('type')](**data)
+
+class RemoteProcess:
+    '''
+    Stands in for the asyncio process of a croc running in a transfer worker, enough of it for /kill
+    '''
+    def __init__(self, session):
+        self.session = session
+
+    @property
+    def pid(self) -> int:
+        return self.session.pid
+
+    @property
+    def returncode(self) -> int | None:
+        return self.session.returncode
+
+    def kill(self):
+        self.session.kill()
+
+    def terminate(self):
+        self.session.kill()
+
+    async def wait(self) -> int | None:
+        await self.session.exited.wait()
+        return self.session.returncode
+
+class RemoteCrocSession(CrocSession):
+    '''
+    A CrocSession whose croc is spawned, read and parsed by a transfer worker process. Events
+    arrive already parsed over the worker's pipe, the rest of the interface is unchanged.
+    '''
+    def __init__(self, workers, args:list[str], stdin:bool = False):
+        super().__init__(args, stdin)
+        self.workers = workers
+        self.worker = None
+        self.id = None
+        self.queue = asyncio.Queue()
+        self.started = None
+        self.exited = asyncio.Event()
+        self._pid = None
+        self._returncode = None
+        self.process = RemoteProcess(self)
+
+    @property
+    def pid(self) -> int:
+        return self._pid
+
+    @property
+    def returncode(self) -> int | None:
+        return self._returncode
+
+    async def start(self):
+        self.started = asyncio.get_running_loop().create_future()
+        self.worker = await self.workers.assign(self)
+        self.worker.send({'op': 'start', 'id': self.id, 'args': self.args, 'stdin': self.stdin})
+        await self.started
+        return self
+
+    def receive(self, message:dict):
+        kind = message['type']
+        if kind == 'started':
+            self._pid = message['pid']
+            if not self.started.done():
+                self.started.set_result(None)
+        elif kind == 'failed':
+            self.exit(None)
+            if not self.started.done():
+                self.started.set_exception(OSError(message['error']))
+        elif kind == 'event':
+            event = decode_event(message['event'])
+            if isinstance(event, DoneEvent):
+                self.exit(event.returncode)
+            self.queue.put_nowait(event)
+
+    def lost(self, reason:str):
+        '''
+        The worker running this session went away
+        '''
+        if not self.started.done():
+            self.started.set_exception(OSError(reason))
+        if self.exited.is_set():
+            return
+        self.exit(-1)
+        self.queue.put_nowait(ErrorEvent(reason))
+        self.queue.put_nowait(DoneEvent(-1))
+
+    def exit(self, returncode:int | None):
+        self._returncode = returncode
+        self.exited.set()
+        self.workers.release(self)
+
+    async def next_event(self):
+        '''
+        The next parsed event, DoneEvent once croc has exited and None after that
+        '''
+        if self.finished:
+            return None
+        event = await self.queue.get()
+        if isinstance(event, DoneEvent):
+            self.finished = True
+        self.emit(event)
+        return event
+
+    async def answer(self, accept:bool):
+        self.worker.send({'op': 'answer', 'id': self.id, 'accept': accept})
+
+    def kill(self):
+        if not self.exited.is_set():
+            self.worker.send({'op': 'kill', 'id': self.id})
+
+    async def close(self):
+        if not self.exited.is_set():
+            self.worker.send({'op': 'close', 'id': self.id})
+        await self.exited.wait()
+
+class TransferWorker:
+    '''
+    One `python -m src.transfer_workers` child process. Requests go in on its stdin and parsed
+    events, session status and log records come back on its stdout, one JSON object per line.
+    '''
+    def __init__(self, number:int):
+        self.number = number
+        self.process = None
+        self.reader = None
+        self.sessions: dict[int, RemoteCrocSession] = {}
+        self.logger = get_logger()
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'src.transfer_workers',
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            limit=IPC_LINE_LIMIT,
+            # the worker runs in the bot's working directory (config.json, ./files) wherever the package lives
+            env={**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, (PACKAGE_ROOT, os.environ.get('PYTHONPATH'))))},
+        )
+        self.reader = asyncio.create_task(self._read(self.process))
+        self.logger.info(f'WORKER - {self.number} - started transfer worker with pid: {self.process.pid}')
+
+    def send(self, message:dict):
+        self.process.stdin.write(json.dumps(message).encode() + b'\n')
+
+    async def _read(self, process):
+        try:
+            while line := await process.stdout.readline():
+                message = json.loads(line)
+                if message['type'] == 'log':
+                    self.logger.log(message['level'], message['message'], extra={'worker': self.number, **message.get('extra', {})})
+                    continue
+                session = self.sessions.get(message['id'])
+                if session is not None:
+                    session.receive(message)
+        except Exception as e:
+            self.logger.error(f'ERROR - WORKER - {self.number} - bad message from transfer worker: {e}')
+            process.kill()
+        await process.wait()
+        level = logging.WARNING if self.sessions or process.returncode else logging.INFO
+        self.logger.log(level, f'WORKER - {self.number} - transfer worker {process.pid} exited with {process.returncode}, failing {len(self.sessions)} transfers')
+        for session in list(self.sessions.values()):
+            session.lost('the transfer worker running this transfer stopped')
+        self.sessions.clear()
+
+    async def stop(self):
+        if not self.alive:
+            return
+        self.process.stdin.close()
+        try:
+            await asyncio.wait_for(self.process.wait(), 10)
+        except asyncio.TimeoutError:
+            self.process.kill()
+            await self.process.wait()
+
+class TransferWorkers:
+    '''
+    A pool of transfer worker processes, started on first use. Each new session goes to the
+    worker with the fewest running sessions and a worker that died is restarted on the next one.
+    '''
+    def __init__(self, count:int):
+        self.workers = [TransferWorker(number) for number in range(count)]
+        self.ids = itertools.count()
+        self.lock = asyncio.Lock()
+
+    def session(self, args:list[str], stdin:bool = False) -> RemoteCrocSession:
+        return RemoteCrocSession(self, args, stdin)
+
+    async def assign(self, session:RemoteCrocSession) -> TransferWorker:
+        async with self.lock:
+            worker = min(self.workers, key=lambda worker: (len(worker.sessions), not worker.alive))
+            if not worker.alive:
+                await worker.start()
+        session.id = next(self.ids)
+        worker.sessions[session.id] = session
+        return worker
+
+    def release(self, session:RemoteCrocSession):
+        if session.worker is not None:
+            session.worker.sessions.pop(session.id, None)
+
+    async def stop(self):
+        await asyncio.gather(*(worker.stop() for worker in self.workers))
+
+_TRANSFER_WORKERS = None
+
+def get_transfer_workers() -> TransferWorkers | None:
+    '''
+    The worker pool, or None when transfer_workers is 0 and croc runs in the bot process
+    '''
+    global _TRANSFER_WORKERS
+    if _TRANSFER_WORKERS is None:
+        count = get_config().transfer_workers
+        if count <= 0:
+            return None
+        _TRANSFER_WORKERS = TransferWorkers(count)
+    return _TRANSFER_WORKERS
+
+def croc_session(args:list[str], stdin:bool = False) -> CrocSession:
+    workers = get_transfer_workers()
+    if workers is None:
+        return CrocSession(args, stdin)
+    return workers.session(args, stdin)
+
+class PipeHandler(logging.Handler):
+    '''
+    Sends a worker's log records up to the bot process, which writes them with its own handlers
+    '''
+    def __init__(self, write):
+        super().__init__()
+        self.write = write
+
+    def emit(self, record:logging.LogRecord):
+        try:
+            extra = {'pid': record.pid} if hasattr(record, 'pid') else {}
+            self.write({'type': 'log', 'level': record.levelno, 'message': record.getMessage(), 'extra': extra})
+        except Exception:
+            self.handleError(record)
+
+class WorkerServer:
+    '''
+    The worker side: runs croc sessions on request and forwards their parsed events. Progress
+    redraws are coalesced to one every PROGRESS_FORWARD_INTERVAL_S per session, anything else
+    is forwarded straight away after the latest pending progress.
+    '''
+    def __init__(self):
+        self.sessions: dict[int, CrocSession] = {}
+        self.write_lock = threading.Lock()
+        self.logger = logging.getLogger('float')
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(PipeHandler(self.write))
+        self.logger.propagate = False
+
+    def write(self, message:dict):
+        with self.write_lock:
+            sys.stdout.buffer.write(json.dumps(message).encode() + b'\n')
+            sys.stdout.buffer.flush()
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=IPC_LINE_LIMIT)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        while line := await reader.readline():
+            try:
+                await self.handle(json.loads(line))
+            except Exception as e:
+                self.logger.error(f'ERROR - WORKER - failed to handle request {line[:200]}: {e}')
+        # the bot went away, take its transfers with it
+        await asyncio.gather(*(session.close() for session in self.sessions.values()), return_exceptions=True)
+
+    async def handle(self, message:dict):
+        op = message['op']
+        id = message['id']
+        if op == 'start':
+            try:
+                session = await CrocSession(message['args'], message['stdin']).start()
+            except Exception as e:
+                self.write({'type': 'failed', 'id': id, 'error': str(e)})
+                return
+            self.sessions[id] = session
+            self.write({'type': 'started', 'id': id, 'pid': session.pid})
+            asyncio.create_task(self.forward(id, session))
+            return
+        session = self.sessions.get(id)
+        if session is None:
+            return
+        if op == 'answer':
+            await session.answer(message['accept'])
+        elif op == 'kill':
+            session.kill()
+        elif op == 'close':
+            asyncio.create_task(session.close())
+
+    async def forward(self, id:int, session:CrocSession):
+        pending = None
+        forwarded = 0.0
+        try:
+            while (event := await session.next_event()) is not None:
+                if isinstance(event, ProgressEvent):
+                    now = time.monotonic()
+                    if now - forwarded < PROGRESS_FORWARD_INTERVAL_S:
+                        pending = event
+                        continue
+                    forwarded = now
+                elif pending is not None:
+                    self.write({'type': 'event', 'id': id, 'event': encode_event(pending)})
+                pending = None
+                self.write({'type': 'event', 'id': id, 'event': encode_event(event)})
+        except Exception as e:
+            self.logger.error(f'ERROR - WORKER - lost croc {session.pid}: {e}')
+            session.kill()
+            await session.close()
+            self.write({'type': 'event', 'id': id, 'event': encode_event(DoneEvent(session.returncode))})
+        finally:
+            self.sessions.pop(id, None)
+
+if __name__ == '__main__':
+    asyncio.run(WorkerServer().serve())
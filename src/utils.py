@@ -1,9 +1,14 @@
 from datetime import datetime
+import atexit
+import contextvars
 import json
 import logging
+import logging.handlers
+import queue
+import random
+import time
 from types import SimpleNamespace
 import re
-import os
 
 class Config(SimpleNamespace):
     @classmethod
@@ -12,9 +17,23 @@ class Config(SimpleNamespace):
             data = json.load(config_file)
         return cls(**data)
 
+_CONFIG = None
+
+def get_config() -> Config:
+    '''
+    config.json, read on first use and shared after that
+    '''
+    global _CONFIG
+    if _CONFIG is None:
+        _CONFIG = Config.from_json()
+    return _CONFIG
+
 def format_time_difference(start_time:datetime, end_time:datetime) -> str:
     time_difference = end_time - start_time
-    total_seconds = int(time_difference.total_seconds())
+    return format_duration(time_difference.total_seconds())
+
+def format_duration(seconds:float) -> str:
+    total_seconds = int(seconds)
     hours, remainder = divmod(total_seconds, 3600)
     minutes, seconds = divmod(remainder, 60)
     return f"{hours:02}:{minutes:02}:{seconds:02}"
@@ -37,28 +56,108 @@ def convert_to_mb(size:float, unit:str) -> float:
 def get_safe_guild_name(guild_name:str | None) -> str:
     if guild_name is None:
         raise ValueError("guild_name was not found")
-    safe_name = re.sub(r'[<>:"/\\|?* ]', '_', guild_name).lower()
-    if not os.path.exists(f'./files/{safe_name}/'):
-        os.makedirs(f'./files/{safe_name}/')
-    return safe_name
+    return re.sub(r'^\.|[<>:"/\\|?* ]', '_', guild_name).lower()
+
+LOG_CONTEXT = contextvars.ContextVar('log_context', default={})
+LOG_FIELDS = ('guild', 'user', 'command', 'pid', 'worker')
+
+def set_log_context(**fields):
+    '''
+    Attach fields (guild, user, command...) to every log record from the current task and
+    the tasks it starts
+    '''
+    LOG_CONTEXT.set({**LOG_CONTEXT.get(), **fields})
+
+class ContextFilter(logging.Filter):
+    def filter(self, record:logging.LogRecord) -> bool:
+        for key, value in LOG_CONTEXT.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        message = record.msg if isinstance(record.msg, str) else ''
+        record.category = message.split(' - ', 1)[0] if ' - ' in message else ''
+        return True
+
+class SamplingFilter(logging.Filter):
+    '''
+    Thins out DEBUG records per category (the text before the first " - "): keeps a random
+    sample_rates[category] share of them, then at most rate_limits[category] per second.
+    The next record let through reports how many were dropped.
+    '''
+    def __init__(self, sample_rates:dict[str, float], rate_limits:dict[str, float]):
+        super().__init__()
+        self.sample_rates = sample_rates
+        self.rate_limits = rate_limits
+        self.tokens: dict[str, float] = {}
+        self.refilled: dict[str, float] = {}
+        self.dropped: dict[str, int] = {}
+
+    def filter(self, record:logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        category = getattr(record, 'category', '')
+        rate = self.sample_rates.get(category)
+        if rate is not None and random.random() >= rate:
+            return self._drop(category)
+        limit = self.rate_limits.get(category)
+        if limit is not None:
+            now = time.monotonic()
+            tokens = min(limit, self.tokens.get(category, limit) + (now - self.refilled.get(category, now)) * limit)
+            self.refilled[category] = now
+            if tokens < 1:
+                self.tokens[category] = tokens
+                return self._drop(category)
+            self.tokens[category] = tokens - 1
+        dropped = self.dropped.pop(category, 0)
+        if dropped:
+            record.dropped = dropped
+        return True
+
+    def _drop(self, category:str) -> bool:
+        self.dropped[category] = self.dropped.get(category, 0) + 1
+        return False
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record:logging.LogRecord) -> str:
+        data = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'category': getattr(record, 'category', ''),
+            'message': record.getMessage(),
+        }
+        for field in (*LOG_FIELDS, 'dropped'):
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        return json.dumps(data, default=str)
 
 def get_logger() -> logging.Logger:
+    '''
+    The bot's logger. Records are only filtered and queued on the calling thread, formatting and
+    file/console I/O run on a background listener thread. The file gets one JSON object per line
+    and is rotated past log_max_mb.
+    '''
     logger = logging.getLogger('float')
-    logger.setLevel(logging.DEBUG)
 
     if not logger.handlers:
-        file_handler = logging.FileHandler('./log.log')
-        file_handler.setLevel(logging.DEBUG)
+        config = get_config()
+        logger.setLevel(config.log_level)
+
+        file_handler = logging.handlers.RotatingFileHandler(config.log_file, maxBytes=int(config.log_max_mb * 1024 * 1024), backupCount=config.log_backup_count)
+        file_handler.setFormatter(JsonFormatter())
 
         console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.DEBUG)
+        console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        file_handler.setFormatter(formatter)
-        console_handler.setFormatter(formatter)
+        log_queue = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.addFilter(ContextFilter())
+        queue_handler.addFilter(SamplingFilter(config.log_sample_rates, config.log_rate_limits))
+        listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
 
-        logger.addHandler(file_handler)
-        logger.addHandler(console_handler)
+        logger.addHandler(queue_handler)
+        logger.propagate = False
 
     return logger
-
@@ -0,0 +1,136 @@
+from collections import Counter
+from dataclasses import dataclass
+import asyncio
+import time
+from src.croc import CodeEvent, CrocSession
+from src.journal import get_transfer_journal
+from src.transfer_workers import croc_session
+from src.utils import get_logger
+
+CODE_TIMEOUT_S = 30
+
+@dataclass
+class WarmSender:
+    session: CrocSession
+    code: CodeEvent
+    snapshot: tuple | None
+    created: float
+    journal_id: str
+
+class WarmPool:
+    '''
+    Keeps a croc sender with its code already issued for each guild's top_k most requested files
+    that were asked for at least min_requests times, so /download of a hot file can reply without
+    waiting on croc's relay negotiation. Senders are only spawned by maintain(), every interval,
+    after which request counts are halved so the pool follows what is popular now. Senders idle
+    for longer than idle_s, or whose file changed since they were spawned, are killed.
+    '''
+    def __init__(self, croc_command, top_k:int, min_requests:int, idle_s:float, interval_s:float):
+        self.croc_command = croc_command
+        self.top_k = top_k
+        self.min_requests = min_requests
+        self.idle_s = idle_s
+        self.interval_s = interval_s
+        self.requests: dict[str, Counter] = {}
+        self.snapshots: dict[tuple[str, str], tuple | None] = {}
+        self.ready: dict[tuple[str, str], WarmSender] = {}
+        self.spawning: set[tuple[str, str]] = set()
+        self.journal = get_transfer_journal()
+        self.logger = get_logger()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._maintain_loop())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for sender in self.ready.values():
+            self.discard(sender)
+        self.ready.clear()
+
+    def count(self, guild:str) -> int:
+        return sum(1 for key in self.ready if key[0] == guild)
+
+    def record(self, guild:str, path:str, snapshot:tuple | None):
+        self.requests.setdefault(guild, Counter())[path] += 1
+        self.snapshots[(guild, path)] = snapshot
+
+    def take(self, guild:str, path:str, snapshot:tuple | None) -> WarmSender | None:
+        '''
+        Hand over the ready sender for path, the caller owns it from then on. The next maintain()
+        starts a replacement if path is still hot.
+        '''
+        key = (guild, path)
+        sender = self.ready.pop(key, None)
+        if sender is not None and (sender.session.returncode is not None or sender.snapshot != snapshot):
+            self.discard(sender)
+            sender = None
+        elif sender is not None:
+            self.journal.end(sender.journal_id, 'taken')
+        return sender
+
+    def discard(self, sender:WarmSender):
+        sender.session.kill()
+        self.journal.end(sender.journal_id, 'expired')
+
+    def _spawn(self, key:tuple[str, str]):
+        if key in self.spawning or key in self.ready:
+            return
+        self.spawning.add(key)
+        asyncio.create_task(self._fill(key))
+
+    async def _fill(self, key:tuple[str, str]):
+        guild, path = key
+        snapshot = self.snapshots.get(key)
+        session = None
+        journal_id = None
+        try:
+            session = await croc_session([*self.croc_command(), "--yes", "send", path]).start()
+            journal_id = self.journal.begin('warm', guild, pid=session.pid, args=session.args, file=path)
+            event = await session.wait_for(CodeEvent, timeout=CODE_TIMEOUT_S)
+            if not isinstance(event, CodeEvent):
+                raise RuntimeError(f'croc exited before issuing a code: {event}')
+            self.ready[key] = WarmSender(session, event, snapshot, time.monotonic(), journal_id)
+            self.logger.debug(f'WARM - {guild} - sender {session.pid} ready for {path}')
+        except Exception as e:
+            self.logger.warning(f'WARM - {guild} - failed to warm {path}: {e}')
+            if session is not None:
+                session.kill()
+            if journal_id is not None:
+                self.journal.end(journal_id, 'fail')
+        finally:
+            self.spawning.discard(key)
+
+    async def _maintain_loop(self):
+        while True:
+            await asyncio.sleep(self.interval_s)
+            try:
+                self.maintain()
+            except Exception as e:
+                self.logger.error(f'WARM - maintenance failed: {e}')
+
+    def maintain(self):
+        now = time.monotonic()
+        hot = set()
+        for guild, counts in self.requests.items():
+            for path, requests in counts.most_common(self.top_k):
+                if requests >= self.min_requests:
+                    hot.add((guild, path))
+            for path in list(counts):
+                counts[path] //= 2
+                if not counts[path]:
+                    del counts[path]
+        for key, sender in list(self.ready.items()):
+            idle = now - sender.created > self.idle_s
+            if idle or key not in hot or sender.session.returncode is not None:
+                self.ready.pop(key)
+                self.discard(sender)
+                self.logger.debug(f'WARM - {key[0]} - expired sender for {key[1]}')
+        for key in hot:
+            self._spawn(key)
+        for key in list(self.snapshots):
+            if key not in hot and key[1] not in self.requests.get(key[0], ()):
+                del self.snapshots[key]